@@ -0,0 +1,194 @@
+# This file will contain the methods needed to store the rainfall and DHS data compactly (float32 values and integer-coded keys)
+# Caleb Bitting (Colby Class of 2023)
+# Written for research for Professor Daniel LaFave at Colby College
+#
+
+KEY_COLUMNS = ['DHSID', 'IDHSPID']             # coded through the key dictionary
+YEAR_DTYPE = 'int16'
+CODE_DTYPE = 'int32'
+FLOAT_DTYPE = 'float32'
+
+def readCompactCsv(file_path, dictionary):
+    '''This function reads a csv written by the other scripts straight into its compact form
+
+    Args:
+        file_path (str): the path to the csv
+        dictionary (dict): the key dictionary. Modified in place.
+
+    Returns:
+        pd.DataFrame: the compact DataFrame
+    '''
+    import pandas as pd
+    df = pd.read_csv(file_path, dtype={column: 'category' for column in KEY_COLUMNS})     # categories keep the keys small until they are coded
+
+    return compactFrame(df, dictionary)
+
+def keyDictionary():
+    '''This function makes an empty dictionary for encodeKeys() to fill. It lives only as long as the run that codes the keys.
+
+    Returns:
+        dict: a dict of the form {'DHSID': [], 'IDHSPID': []}. encodeKeys() appends each new key, so a key's code is its position in its list.
+    '''
+
+    return {column: [] for column in KEY_COLUMNS}
+
+def encodeKeys(values, column, dictionary):
+    '''This function turns keys into integer codes. Keys not yet in the dictionary are appended to it, so codes never change once given out.
+
+    Args:
+        values (array-like): the keys to encode
+        column (str): which key they are. e.g. 'DHSID'
+        dictionary (dict): the key dictionary. Modified in place.
+
+    Returns:
+        np.array: the int32 codes
+    '''
+    import pandas as pd
+    values = pd.Series(values).astype(str)
+    known = dictionary[column]
+    known_set = set(known)
+    new_keys = [key for key in pd.unique(values) if key not in known_set]
+    known.extend(new_keys)
+    codes = pd.Categorical(values, categories=known).codes
+
+    return codes.astype(CODE_DTYPE)
+
+def decodeKeys(codes, column, dictionary):
+    '''This function turns integer codes back into keys
+
+    Args:
+        codes (array-like): the codes returned by encodeKeys()
+        column (str): which key they are. e.g. 'DHSID'
+        dictionary (dict): the key dictionary
+
+    Returns:
+        np.array: the keys as strings
+    '''
+    import numpy as np
+    return np.asarray(dictionary[column], dtype=object)[np.asarray(codes)]
+
+def compactFrame(df, dictionary):
+    '''This function shrinks a DataFrame: key columns become int32 codes, Year becomes int16, and float64 columns become float32
+
+    Args:
+        df (pd.DataFrame): the DataFrame to shrink
+        dictionary (dict): the key dictionary. Modified in place.
+
+    Returns:
+        pd.DataFrame: the compact DataFrame
+    '''
+    df = df.copy()
+    for column in df.columns:
+        if column in KEY_COLUMNS:
+            df[column] = encodeKeys(df[column], column, dictionary)
+        elif column == 'Year':
+            df[column] = df[column].astype(YEAR_DTYPE)
+        elif df[column].dtype == 'float64':
+            df[column] = df[column].astype(FLOAT_DTYPE)
+
+    return df
+
+def expandFrame(df, dictionary):
+    '''This function decodes the keys of a compact DataFrame so it can be written out like the rest of the scripts write theirs. float32 columns are kept; they print with their own (shorter) precision.
+
+    Args:
+        df (pd.DataFrame): the compact DataFrame
+        dictionary (dict): the key dictionary
+
+    Returns:
+        pd.DataFrame: the DataFrame as the rest of the scripts write it
+    '''
+    df = df.copy()
+    for column in df.columns:
+        if column in KEY_COLUMNS:
+            df[column] = decodeKeys(df[column], column, dictionary)
+        elif column == 'Year':
+            df[column] = df[column].astype('int64')
+
+    return df
+
+def plainFrame(df, dictionary):
+    '''This function rebuilds the DataFrame pd.read_csv() would have produced from a compact one (string keys, int64 and float64 columns). Used to measure the memory saved.
+
+    Args:
+        df (pd.DataFrame): the compact DataFrame
+        dictionary (dict): the key dictionary
+
+    Returns:
+        pd.DataFrame: the plain DataFrame
+    '''
+    df = expandFrame(df, dictionary)
+    dtypes = {}
+    for column in df.columns:
+        if df[column].dtype.kind == 'f':
+            dtypes[column] = 'float64'
+        elif df[column].dtype.kind in 'iu':
+            dtypes[column] = 'int64'
+
+    return df.astype(dtypes)
+
+def memoryReport(label, plain_bytes, compact_bytes):
+    '''This function prints how much memory the compact representation saved
+
+    Args:
+        label (str): what was measured
+        plain_bytes (int): the size of the float64/object representation
+        compact_bytes (int): the size of the compact representation
+
+    Returns:
+        float: the fraction of memory saved
+    '''
+    saved = 1 - compact_bytes / plain_bytes if plain_bytes else 0.
+    print(f'{label}: {plain_bytes / 2**20:.2f} MiB -> {compact_bytes / 2**20:.2f} MiB ({saved:.1%} saved)')
+
+    return saved
+
+def listBytes(lst):
+    '''The memory used by a (possibly nested) list of Python floats
+
+    Args:
+        lst (list): the list to measure
+
+    Returns:
+        int: the number of bytes
+    '''
+    import sys
+    return sys.getsizeof(lst) + sum(listBytes(item) if isinstance(item, list) else sys.getsizeof(item) for item in lst)
+
+def frameBytes(df):
+    '''The memory used by a DataFrame, counting the contents of string columns
+
+    Args:
+        df (pd.DataFrame): the DataFrame to measure
+
+    Returns:
+        int: the number of bytes
+    '''
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+def accuracyReport(label, reference, compact, thresholds=None):
+    '''This function compares float32 results against their float64 reference and prints the error
+
+    Args:
+        label (str): what was compared
+        reference (array-like): the float64 results
+        compact (array-like): the float32 results
+        thresholds (list, optional): if passed, the results are treated as percentiles and the number of drought classifications that differ is reported too
+
+    Returns:
+        dict: the maximum absolute error, the maximum relative error, and (if thresholds were passed) the number of classifications that differ
+    '''
+    import numpy as np
+    reference = np.asarray(reference, dtype=np.float64)
+    compact = np.asarray(compact, dtype=np.float64)
+    error = np.abs(reference - compact)
+    report = {'max_abs_error': float(error.max()) if error.size else 0.,
+              'max_rel_error': float((error / np.maximum(np.abs(reference), np.finfo(np.float64).tiny)).max()) if error.size else 0.}
+    out_str = f'{label}: max abs error {report["max_abs_error"]:.3g}, max rel error {report["max_rel_error"]:.3g}'
+    if thresholds is not None:
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        report['classification_changes'] = int(((reference[..., None] < thresholds) != (compact[..., None] < thresholds)).sum())
+        out_str += f', {report["classification_changes"]} drought classifications changed'
+    print(out_str)
+
+    return report
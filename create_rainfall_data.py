@@ -5,12 +5,8 @@
 
 import os
 import argparse
-import itertools
-import numpy as np
-import pandas as pd
-import csv_polishing
 import rainfall_sums
-import gamma_calculations
+import rainfall_store
 
 def commandLineParser():
     '''This function parses the command line arguments
@@ -24,7 +20,15 @@ def commandLineParser():
     parser.add_argument('--shapefile_path', required=True, type=str, help='the path to the .shp file in a shapefile folder. This folder should be expanded from a .zip file.')
     parser.add_argument('--len_years', required=True, type=int, help='the number of years to use to fit each gamma distribution.')
     parser.add_argument('--output_file', type=str, default='cleanGamma_data.csv', help='the name of the processed csv. Defaults to cleanGamma_data.csv')
+    parser.add_argument('--sums_file', type=str, help='if passed, the rainfall sums (and a manifest of the precip files used) are also written to this csv so that update_rainfall_data.py can extend the build later.')
     parser.add_argument('--windows', '-w', type=str, help='the file path for the list of the names of precip files.')
+    parser.add_argument('--precip_data', type=str, default='./resources/precip_data', help='the folder of precip.YYYY files (plain or gzipped) or a .tar.gz/.tar.xz/.zip archive of them. Defaults to ./resources/precip_data')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[.05, .10, .15], help='the percentile thresholds below which a year counts as a drought. Defaults to .05 .10 .15')
+    parser.add_argument('--lookup_table', action='store_true', help='interpolate the percentiles from a precomputed table of the incomplete gamma function instead of evaluating each one exactly.')
+    parser.add_argument('--full_shapefile', action='store_true', help='build a GeoDataFrame with every column of the shapefile instead of reading only DHSID and the cluster coordinates.')
+    parser.add_argument('--compact', action='store_true', help='keep the rainfall totals as arrays while processing and store the percentiles and the processed csv columns as float32 (and Location/Year as int32/int16). The gamma fits still use float64. Reports the memory saved and the error of the stored percentiles.')
+    parser.add_argument('--kernels', type=str, nargs='+', choices=rainfall_sums.KERNELS, default=['uniform'], help='how to weight the stations within --distance of each cluster. The first kernel is written to --output_file and any others to --output_file with _<kernel> appended. Defaults to uniform')
+    parser.add_argument('--bandwidth', type=float, help='the standard deviation (in km) of the gaussian kernel. Defaults to half of --distance')
     parser.add_argument('--verbose', '-v', action='store_true', help='whether or not to see the intermediate progress bar')
     parser.add_argument('--testing', '-t', action='store_true', help='enter testing mode. All functions will be passed testing=True where possible.')
     parser.add_argument('--determine_distance', default=False, help='needed for file_parsers. DO NOT TOUCH.')
@@ -33,27 +37,39 @@ def commandLineParser():
     return args
 
 def main():
+    import csv_polishing
+    import gamma_calculations
     # command-line arguments
     cmd_args = commandLineParser()
+    # the rows are labelled with the DHSIDs in the .dbf of the shapefile, so fail before any of the work if it is missing
+    dbf_path = os.path.splitext(cmd_args.shapefile_path)[0] + '.dbf'
+    if cmd_args.shapefile_path.endswith('.shp') and not os.path.exists(dbf_path):
+        raise FileNotFoundError(f'{dbf_path} does not exist. It holds the DHSID of every cluster, which the processed csv is keyed on. Unzip the full shapefile folder.')
     # get rainfall sums
     gdf = rainfall_sums.body(cmd_args)
+    totals_columns = [rainfall_sums.totalsColumn(kernel, cmd_args.kernels) for kernel in cmd_args.kernels]
+    if cmd_args.sums_file:
+        rainfall_sums.listifyTotals(gdf[['DHSID', 'Station Indices', 'Station Distances'] + totals_columns].copy()).to_csv(cmd_args.sums_file, index=False)
+        month_range = [int(month) for month in rainfall_sums.fp.cropCalendarParser(cmd_args.unit_code)]
+        rainfall_sums.writeManifest(cmd_args.sums_file, rainfall_sums.precipFileNames(cmd_args.windows, cmd_args.precip_data, testing=cmd_args.testing), month_range, cmd_args.precip_data, cmd_args.kernels, rainfall_sums.kernelBandwidth(cmd_args))
     # eye breathing room
     _, columns = os.popen('stty size', 'r').read().split()
     fancy_sep = ['-' for _ in range(int(columns))]
     print(''.join(fancy_sep)) 
-    # get percentile data
-    rainfall_list = gdf['Rainfall Totals'].tolist()
-    percentiles = gamma_calculations.body(rainfall_list, cmd_args)
-    # edit csv
-    year = 1950 + cmd_args.len_years
-    df = csv_polishing.body(rainfall_list, percentiles, year)
-    # get DHSID
-    DHSID_col = gdf['DHSID'].repeat(len(percentiles[0]))
-    DHSID_col = DHSID_col.reset_index(drop=True)
-    df.insert(0, 'DHSID', DHSID_col, allow_duplicates=True)
-    df.drop('Location', axis=1, inplace=True)
-    # output
-    df.to_csv(cmd_args.output_file, index=False)
+    for kernel, totals_column in zip(cmd_args.kernels, totals_columns):
+        if len(cmd_args.kernels) > 1: print(f'Processing the {kernel} kernel')
+        # get percentile data
+        rainfall_list = gdf[totals_column].tolist()
+        percentiles = gamma_calculations.body(rainfall_list, cmd_args)
+        # edit csv
+        year = 1950 + cmd_args.len_years
+        df = csv_polishing.body(rainfall_list, percentiles, year, cmd_args.thresholds, cmd_args.compact, interpret_log=kernel == cmd_args.kernels[-1])
+        # get DHSID
+        df = csv_polishing.insertDHSID(df, gdf['DHSID'])
+        # output
+        output_file = rainfall_sums.kernelOutputFile(cmd_args.output_file, kernel, cmd_args.kernels)
+        df.to_csv(output_file, index=False)
+        rainfall_store.writeStore(output_file, df)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
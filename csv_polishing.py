@@ -6,46 +6,63 @@
 import os
 import argparse
 import itertools
-import numpy as np
-import pandas as pd
 
-def locationProcessing(percentile_list, rainfall_list):
-    '''This function turns the rainfall totals and precipitation percentiles into the desired form.
+DEFAULT_THRESHOLDS = [.05, .10, .15]
+
+def thresholdColumns(thresholds=DEFAULT_THRESHOLDS):
+    '''This function names the drought columns for a set of thresholds
     
     Args:
-        percentile_list (list): the percentiles for a given location
-        rainfall_list (list): the rainfall totals for a given locatioin
+        thresholds (list, optional): the percentile thresholds. Defaults to [.05, .10, .15]
     
     Returns:
-        list: the interpeted data
+        list: the column names. e.g. ['<5%-ile', '<10%-ile', '<15%-ile']
     '''
-    total_values = []
-    for pyear, ryear in zip(percentile_list, rainfall_list):
-        values = []
-        values.append(percentile_list.index(pyear))
-        pyear = float(pyear)
-        ryear = rainfall_list[rainfall_list.index(ryear) + 30]
-        values.append(pyear < .05)      # 5%-ile
-        values.append(pyear < .10)      # 10%-ile
-        values.append(pyear < .15)      # 15%-ile
-        values.append(round(pyear,4))   # actual %-ile
-        values.append(round(float(ryear), 4))  # rainfall (mm)          CHANGE THIS
-        total_values.append(values)
-    return total_values
-
-def dfProcessing(rain_list, percentile_list, first_year):
-    data_list = [locationProcessing(per, rain) for per, rain in zip(percentile_list, rain_list)]
-    # change unhelpful index numbers into helpful DHSCLUST -- year
-    for location in data_list:
-        for year in location:
-            tempyr = year[0] + first_year
-            year[0] = str(int(data_list.index(location)) + 1)
-            year.insert(1, str(tempyr))
-    # create numpy array
-    shape = (len(data_list[0])*len(data_list))
-    data_array = np.array(data_list).reshape(shape, 7)
+    return [f'<{threshold * 100:g}%-ile' for threshold in thresholds]
+
+def classifyPercentiles(percentiles, thresholds=DEFAULT_THRESHOLDS):
+    '''This function classifies every percentile against every threshold in one call
     
-    return data_array
+    Args:
+        percentiles (array-like): the percentiles. Any shape.
+        thresholds (list, optional): the percentile thresholds. Defaults to [.05, .10, .15]
+    
+    Returns:
+        np.array: a boolean array with the shape of percentiles plus one trailing axis of len(thresholds). True where the percentile is below the threshold.
+    '''
+    import numpy as np
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+
+    return percentiles[..., None] < np.asarray(thresholds, dtype=np.float64)
+
+def dfProcessing(rain_list, percentile_list, first_year, thresholds=DEFAULT_THRESHOLDS, compact=False):
+    '''This function turns every location's rainfall totals and percentiles into the rows of the processed csv at once
+    
+    Args:
+        rain_list (list): the rainfall totals for every location
+        percentile_list (list): the percentiles for every location
+        first_year (int): the year of the first percentile
+        thresholds (list, optional): the percentile thresholds. Defaults to [.05, .10, .15]
+        compact (bool, optional): whether to keep the percentiles and rainfall as float32 and Location and Year as int32 and int16. Defaults to False
+    
+    Returns:
+        dict: the columns of the processed csv (Location, Year, one per threshold, %-ile, Total Rainfall (mm))
+    '''
+    import numpy as np
+    float_dtype, location_dtype, year_dtype = (np.float32, np.int32, np.int16) if compact else (np.float64, np.int64, np.int64)
+    percentiles = np.asarray(percentile_list, dtype=float_dtype)                # locations by years
+    rainfall = np.asarray(rain_list, dtype=float_dtype)
+    rainfall = rainfall[:, rainfall.shape[1] - percentiles.shape[1]:]           # the rainfall of the year each percentile describes
+    num_locations, num_years = percentiles.shape
+    flags = classifyPercentiles(percentiles, thresholds).reshape(-1, len(thresholds))
+    # change unhelpful index numbers into helpful DHSCLUST -- year
+    columns = {'Location': np.repeat(np.arange(1, num_locations + 1, dtype=location_dtype), num_years), 'Year': np.tile(np.arange(first_year, first_year + num_years, dtype=year_dtype), num_locations)}
+    for column, flag in zip(thresholdColumns(thresholds), flags.T):
+        columns[column] = flag
+    columns['%-ile'] = np.round(percentiles.ravel(), 4)
+    columns['Total Rainfall (mm)'] = np.round(rainfall.ravel(), 4)
+
+    return columns
 
 def commandLineParser():
     '''This function parses the command line arguments
@@ -57,6 +74,7 @@ def commandLineParser():
     parser.add_argument('file_path', type=str, help='the path to the csv file containing the output of gamma_calculations.py')
     parser.add_argument('--first_year', type=int, default=1980, help='the year corresponding to the first value of the precipitation percentile. Output by gamma_calculations.py. Defaults to 1980')
     parser.add_argument('--output_file', '-n', type=str, default='cleanGamma_data.csv', help='the name of the processed csv. Defaults to cleanGamma_data.csv')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=DEFAULT_THRESHOLDS, help='the percentile thresholds below which a year counts as a drought. Defaults to .05 .10 .15')
     args = parser.parse_args()
 
     return args
@@ -126,18 +144,36 @@ def dropOrigin(df, file_path='origin_log.csv'):
 
     return df
 
-def body(rain_list, percentile_list, year):
+def insertDHSID(df, dhsids):
+    '''This function swaps the Location column for the DHSID of each row. Location survives dropOrigin(), so the rows after a dropped cluster keep their own DHSID.
+    
+    Args:
+        df (pd.DataFrame): the dataframe returned by body()
+        dhsids (array-like): the DHSID of every location, in the order of the rainfall totals
+    
+    Returns:
+        pd.DataFrame: the same dataframe with DHSID in place of Location
+    '''
+    import numpy as np
+    df.insert(0, 'DHSID', np.asarray(dhsids)[df['Location'].to_numpy() - 1])
+    df.drop('Location', axis=1, inplace=True)
+
+    return df
+
+def body(rain_list, percentile_list, year, thresholds=DEFAULT_THRESHOLDS, compact=False, interpret_log=True):
+    import pandas as pd
     # process data
-    data = dfProcessing(rain_list, percentile_list, year)
-    df = pd.DataFrame(data=data, columns=['Location', 'Year', '<5%-ile', '<10%-ile', '<15%-ile', '%-ile', 'Total Rainfall (mm)'])
+    data = dfProcessing(rain_list, percentile_list, year, thresholds, compact)
+    df = pd.DataFrame(data=data)
     df = dropOrigin(df)
-    logInterpreter()
+    if interpret_log: logInterpreter()          # this removes origin_log.csv so it must come after the last dropOrigin()
 
     return df
 
 def main():
     # import needed data
     cmd_args = commandLineParser()
+    import pandas as pd
     input_df = pd.read_csv(cmd_args.file_path)
     # get the lists out of the df
     percentile_list = input_df['Rainfall Percentiles'].tolist()
@@ -145,12 +181,9 @@ def main():
     rain_list = input_df['Rainfall Totals'].tolist()
     rain_list = [item.strip('][').split(', ') for item in rain_list]
     # process
-    df = body(rain_list, percentile_list, cmd_args.first_year)
+    df = body(rain_list, percentile_list, cmd_args.first_year, cmd_args.thresholds)
     # get DHSID
-    DHSID_col = input_df['DHSID'].repeat(len(percentile_list[0]))
-    DHSID_col = DHSID_col.reset_index(drop=True)
-    df.insert(0, 'DHSID', DHSID_col, allow_duplicates=True)
-    df.drop('Location', axis=1, inplace=True)
+    df = insertDHSID(df, input_df['DHSID'])
     # export to csv
     df.to_csv(cmd_args.output_file, index=False)
 
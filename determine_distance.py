@@ -7,12 +7,8 @@ import os
 import math
 import argparse
 import statistics
-import numpy as np
-import pandas as pd
 import file_parsers as fp
 import csv_polishing as cp
-import matplotlib.pyplot as plt
-from matplotlib.ticker import PercentFormatter
 
 def commandLineParser():
     '''This function parses the command line arguments
@@ -23,6 +19,7 @@ def commandLineParser():
     parser = argparse.ArgumentParser()
     parser.add_argument('shapefile_path', type=str, help='the path to the .shp file in a shapefile folder. This folder should be expanded from a .zip file.')
     parser.add_argument('num_stations', type=int, help='the minimum distance to the (nth) station will be returned. ')
+    parser.add_argument('--precip_data', type=str, default='./resources/precip_data', help='the folder of precip.YYYY files (plain or gzipped) or a .tar.gz/.tar.xz/.zip archive of them. Defaults to ./resources/precip_data')
     parser.add_argument('--testing', action='store_true', help='enter testing mode. All functions will be passed testing=True where possible.')
     parser.add_argument('--determine_distance', default=True, help='needed for file_parsers. DO NOT TOUCH.')
     args = parser.parse_args()
@@ -32,8 +29,9 @@ def commandLineParser():
 def main():
     # get command-line args
     cmd_args = commandLineParser()
+    import pandas as pd
     # bring in station distances
-    st_coords = fp.precipFileParser('./resources/precip_data/precip.1977', [4, 8], return_coords=True)
+    st_coords = fp.stationCoords(cmd_args.precip_data)
     raw_distances_list = fp.shapeFileParser(cmd_args.shapefile_path, st_coords, cmd_args, testing=cmd_args.testing)
     # drop the ones at the origin
     clust_nums = cp.interpretOriginLog('origin_log.csv')
@@ -53,6 +51,9 @@ def main():
     print(f'Mean: {round(statistics.mean(minimum_distances), 2)}')
     print(f'Max: {round(max(minimum_distances), 2)}')
     # histogram output
+    import numpy as np
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import PercentFormatter
     bin_num = int(1 + 3.322*math.log10(len(minimum_distances)))
     plt.hist(minimum_distances, weights=np.ones(len(minimum_distances)) / len(minimum_distances), bins=bin_num)
     plt.xlabel('Distance Value')
@@ -5,11 +5,15 @@
 
 import os
 import re
+import gzip
 import time
-import itertools
-import geopandas as gpd
-from haversine import haversine
-from tqdm import tqdm as progress
+import queue
+import tarfile
+import zipfile
+import threading
+
+STATION_YEAR = 1977         # the year whose precip file the station coordinates are read from. Every year has the same stations
+_archives = {}              # archive path, size and mtime -> {'members': archiveMembers(), 'texts': {name: text of the STATION_YEAR file}}
 
 def timeIt(f):
     '''This decorator times a function.
@@ -24,18 +28,19 @@ def timeIt(f):
 
     return wrapper
     
-def pointDist(point1, pointlist, index):
+def pointDist(latitude, longitude, pointlist, index):
     '''This function calculates the distance between one point and a list of others
     
     Args:
-        point1 (shapely.geometry.Point): the point against which to calculate all of the distances
-        pointlist (list): a list of shapely.geometry.Point objecsts against which the distances are calculated
+        latitude (float): the latitude of the point against which to calculate all of the distances
+        longitude (float): the longitude of the point against which to calculate all of the distances
+        pointlist (list): a list of (latitude, longitude) tuples against which the distances are calculated
+        index (int): the index of the point. Logged to origin_log.csv if the point is at the origin.
     
     Returns:
         list: a list of distances between the two points as if they were in meters
     '''
-    latitude = point1.y
-    longitude = point1.x
+    from haversine import haversine
     # filter out the origin points
     if latitude == 0 and longitude == 0:
         with open('origin_log.csv', 'a') as f:
@@ -62,35 +67,362 @@ def precipListParser(file_path, testing=False):
 
     return precip_contents
 
-def shapeFileParser(file_path, station_coords, cmd_args, testing=False):
+def precipFolderListing(precip_data_folder):
+    '''This function lists the precip.YYYY files in a folder without shelling out to ls
+    
+    Args:
+        precip_data_folder (str): the path to the folder in which the precip files are stored
+    
+    Returns:
+        list: the sorted names of the precip files. e.g. ['precip.1950', 'precip.1951', ...]
+    '''
+    # input validation
+    if not isinstance(precip_data_folder, str): raise TypeError(f'precip_data_folder must be a string. You passed a {type(precip_data_folder)}.')
+
+    return sorted(name for name in os.listdir(precip_data_folder) if name.startswith('precip') and os.path.isfile(os.path.join(precip_data_folder, name)))
+
+def isPrecipArchive(precip_source):
+    '''Whether a precip source is an archive (.tar, .tar.gz, .tar.xz, .zip, ...) rather than a folder
+    
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+    
+    Returns:
+        bool: True if it is an archive
+    '''
+    return os.path.isfile(precip_source) and (tarfile.is_tarfile(precip_source) or zipfile.is_zipfile(precip_source))
+
+def archiveCache(precip_source):
+    '''This function finds what has already been read out of an archive by this process. Every full pass over an archive fills it in, so later
+    listings and station coordinates don't decompress the archive again. It is keyed on the size and modification time, so a replaced archive starts empty.
+    
+    Args:
+        precip_source (str): the path to the archive
+    
+    Returns:
+        dict: a dict of the form {'members': dict or None, 'texts': {name: text}}
+    '''
+    stat = os.stat(precip_source)
+
+    return _archives.setdefault((os.path.abspath(precip_source), stat.st_size, stat.st_mtime_ns), {'members': None, 'texts': {}})
+
+def archiveMembers(precip_source):
+    '''This function maps the name of every precip file in an archive to its info. Folders inside the archive are ignored.
+    A tar archive is read from front to back to list it, so the text of the STATION_YEAR file is kept on the way for stationCoords().
+    
+    Args:
+        precip_source (str): the path to the archive
+    
+    Returns:
+        dict: a dict of the form {'precip.1950': (member name, size, mtime), ...}
+    '''
+    cache = archiveCache(precip_source)
+    if cache['members'] is not None:
+        return cache['members']
+    members = {}
+    if zipfile.is_zipfile(precip_source):
+        with zipfile.ZipFile(precip_source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and os.path.basename(info.filename).startswith('precip'):
+                    members[os.path.basename(info.filename)] = (info.filename, info.file_size, int(time.mktime(info.date_time + (0, 0, -1))))
+    else:
+        with tarfile.open(precip_source, 'r:*') as archive:
+            for info in archive:
+                name = os.path.basename(info.name)
+                if info.isfile() and name.startswith('precip'):
+                    members[name] = (info.name, info.size, int(info.mtime))
+                    if precipFileYear(name) == STATION_YEAR:
+                        cache['texts'][name] = archive.extractfile(info).read().decode('ascii')
+    cache['members'] = members
+
+    return members
+
+def precipSourceListing(precip_source):
+    '''This function lists the precip.YYYY files (or gzipped precip.YYYY.gz files) in a folder or an archive
+    
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+    
+    Returns:
+        list: the sorted names of the precip files
+    '''
+    if isPrecipArchive(precip_source):
+        return sorted(archiveMembers(precip_source))
+
+    return precipFolderListing(precip_source)
+
+def precipSourceStats(precip_source, names):
+    '''This function records the size and modification time of precip files so later runs can tell whether they changed
+    
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+        names (list): the names of the precip files
+    
+    Returns:
+        list: a list of dicts of the form [{'name': 'precip.1950', 'size': 123, 'mtime': 456}, ...]
+    '''
+    if isPrecipArchive(precip_source):
+        members = archiveMembers(precip_source)
+        return [{'name': name, 'size': members[name][1], 'mtime': members[name][2]} for name in names]
+    stats = []
+    for name in names:
+        file_stat = os.stat(os.path.join(precip_source, name))
+        stats.append({'name': name, 'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns})
+
+    return stats
+
+def readPrecipFiles(precip_source, names):
+    '''This generator reads the text of precip files from a folder (plain or gzipped files) or streams it out of an archive
+    
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+        names (list): the names of the precip files to read
+    
+    Yields:
+        tuple: (name, text) for every file in names. Archives are read front to back, so files come out in archive order.
+    '''
+    wanted = set(names)
+    if not isPrecipArchive(precip_source):
+        for name in names:
+            path = os.path.join(precip_source, name)
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(path, 'rt') as f:
+                yield name, f.read()
+    elif zipfile.is_zipfile(precip_source):
+        members = archiveMembers(precip_source)
+        with zipfile.ZipFile(precip_source) as archive:
+            for name in names:
+                yield name, archive.read(members[name][0]).decode('ascii')
+    else:
+        cache = archiveCache(precip_source)
+        members = {}
+        with tarfile.open(precip_source, 'r|*') as archive:          # stream mode: one sequential pass over the compressed file
+            for info in archive:
+                name = os.path.basename(info.name)
+                if not info.isfile() or not name.startswith('precip'):
+                    continue
+                members[name] = (info.name, info.size, int(info.mtime))
+                if name in wanted or precipFileYear(name) == STATION_YEAR:
+                    text = archive.extractfile(info).read().decode('ascii')
+                    if precipFileYear(name) == STATION_YEAR:
+                        cache['texts'][name] = text
+                    if name in wanted:
+                        yield name, text
+        cache['members'] = members                                  # only reached if the whole archive was read
+
+def prefetch(iterable, depth=4):
+    '''This generator runs an iterable in a background thread, so reading and decompressing the next files overlaps with parsing the current one.
+    zlib and lzma release the GIL while they decompress.
+    
+    Args:
+        iterable (iterable): the iterable to run ahead of the consumer
+        depth (int, optional): how many items may be waiting. Defaults to 4
+    
+    Yields:
+        the items of iterable, in order
+    '''
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()                                        # set when the consumer is finished, even if it stopped early
+    done = object()
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+            return
+        put((done, None))
+    producer_thread = threading.Thread(target=producer, daemon=True)
+    producer_thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer_thread.join()                                      # the producer finishes the item it is on, then sees stop
+        close = getattr(iterable, 'close', None)                    # a generator can only be closed once its thread has let go of it
+        if close is not None:
+            close()
+
+def stationCoords(precip_source, year=STATION_YEAR, use_server=True):
+    '''This function reads the coordinates of every precip station. Every year's file has the same stations, so one year is enough.
+    
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+        year (int, optional): the year of the file to read them from. Defaults to STATION_YEAR (1977)
+        use_server (bool, optional): whether to get the coordinates from precip_server.py if it is running. Defaults to True
+    
+    Returns:
+        list: a two-dimentional list of the form [[x1, y1], [x2, y2], ...]. When precip_server.py supplies it, a read-only np.array of the same shape in shared memory.
+    '''
+    if use_server:
+        import precip_server
+        coords = precip_server.requestStationCoords(precip_source, year)
+        if coords is not None:
+            return coords
+    name = [name for name in precipSourceListing(precip_source) if precipFileYear(name) == year][0]
+    if isPrecipArchive(precip_source) and name in archiveCache(precip_source)['texts']:
+        text = archiveCache(precip_source)['texts'][name]           # kept by an earlier pass over the archive
+    else:
+        _, text = next(readPrecipFiles(precip_source, [name]))
+
+    return precipFileParser(name, [4, 8], return_coords=True, raw_file_contents=text)
+
+def precipFileYear(file_name):
+    '''This function pulls the year out of the name of a precip.YYYY file
+    
+    Args:
+        file_name (str): the name (or path) of the precip file
+    
+    Returns:
+        int: the year the file represents
+    '''
+    return int(os.path.basename(file_name).split('.')[1])
+
+def dbfParser(file_path, columns):
+    '''This function reads only some of the fields of a dBase (.dbf) file. Every record is the same width, so each field is a strided slice of the file.
+    
+    Args:
+        file_path (str): the path to the .dbf file
+        columns (list): the names of the fields to read. e.g. ['DHSID', 'LATNUM', 'LONGNUM']
+    
+    Returns:
+        dict: a dict mapping each field name to a np.array. Numeric fields are float64 and everything else is str.
+    '''
+    import struct
+    import numpy as np
+    with open(file_path, 'rb') as f:
+        contents = f.read()
+    num_records, header_length, record_length = struct.unpack('<IHH', contents[4:12])
+    # field descriptors are 32 bytes each and end with 0x0D
+    fields = {}
+    offset = 1                                                      # every record starts with a deletion flag
+    for start in range(32, header_length - 1, 32):
+        if contents[start] == 0x0D:
+            break
+        name = contents[start:start + 11].split(b'\x00')[0].decode('ascii')
+        field_type = chr(contents[start + 11])
+        length = contents[start + 16]
+        fields[name] = (offset, length, field_type)
+        offset += length
+    missing = [column for column in columns if column not in fields]
+    if missing: raise KeyError(f'{file_path} does not have the fields {missing}. It has {list(fields)}.')
+    records = np.frombuffer(contents, dtype=np.uint8, count=num_records * record_length, offset=header_length).reshape(num_records, record_length)
+    output = {}
+    for column in columns:
+        offset, length, field_type = fields[column]
+        raw = np.char.strip(np.ascontiguousarray(records[:, offset:offset + length]).view(f'S{length}').ravel())
+        if field_type in 'NF':
+            output[column] = np.where(raw == b'', b'nan', raw).astype(np.float64)
+        else:
+            output[column] = np.char.decode(raw, 'latin-1')
+
+    return output
+
+def shpPointParser(file_path):
+    '''This function reads the coordinates of a point shapefile (.shp) straight into arrays. Point records are all 28 bytes, so the file is read as one structured array.
+    
+    Args:
+        file_path (str): the path to the .shp file
+    
+    Returns:
+        tuple: contiguous float64 arrays of the x (longitude) and y (latitude) coordinates, or None if the file holds anything but points (e.g. null shapes)
+    '''
+    import struct
+    import numpy as np
+    with open(file_path, 'rb') as f:
+        contents = f.read()
+    shape_type = struct.unpack('<i', contents[32:36])[0]
+    if shape_type != 1 or (len(contents) - 100) % 28 != 0:
+        return None
+    record_dtype = np.dtype([('number', '>i4'), ('length', '>i4'), ('shape_type', '<i4'), ('x', '<f8'), ('y', '<f8')])
+    records = np.frombuffer(contents, dtype=record_dtype, offset=100)
+    if not (records['shape_type'] == 1).all():
+        return None
+
+    return np.ascontiguousarray(records['x']), np.ascontiguousarray(records['y'])
+
+def clusterLocations(file_path):
+    '''This function reads just the DHSID and coordinates of every DHS cluster. The .shp and .dbf files are read directly; geopandas is only used (with only the DHSID column) if they can't be.
+    
+    Args:
+        file_path (string): a file path to the .shp file in the unzipped .zip shapefile folder
+    
+    Returns:
+        tuple: the DHSIDs, latitudes, and longitudes of the clusters as np.arrays. The DHSIDs are None if the shapefile has no .dbf (e.g. the bundled KEGE71FL)
+    '''
+    dbf_path = os.path.splitext(file_path)[0] + '.dbf'
+    has_dbf = os.path.exists(dbf_path)
+    coords = shpPointParser(file_path)
+    if coords is not None:
+        if not has_dbf:
+            return None, coords[1], coords[0]
+        fields = dbfParser(dbf_path, ['DHSID'])
+        if len(fields['DHSID']) == len(coords[0]):
+            return fields['DHSID'], coords[1], coords[0]
+    import numpy as np
+    import geopandas as gpd
+    gdf = gpd.read_file(file_path, columns=['DHSID'] if has_dbf else None)
+    dhsids = gdf['DHSID'].to_numpy() if 'DHSID' in gdf.columns else None
+
+    return dhsids, np.ascontiguousarray(gdf.geometry.y.to_numpy()), np.ascontiguousarray(gdf.geometry.x.to_numpy())
+
+def shapeFileParser(file_path, station_coords, cmd_args, testing=False, full_geodataframe=False):
     '''This function onboards the shapefile data to create the necessary railfall data
     
     Args:
         file_path (string): a file path to the .shp file in the unzipped .zip shapefile folder
         station_coords (list): a list generated by the stationCoords function
         cmd_args (argparse.Namespace): a namespace to grab command-line arguments
-        testing (bool, optional): whether or not the function is being tested. If passed as True, only the first ten locations will be used for the sake of speed. Defaults to False
+        testing (bool, optional): whether or not the function is being tested. If passed as True, only the first hundred locations will be used for the sake of speed. Defaults to False
+        full_geodataframe (bool, optional): whether to build a GeoDataFrame with every shapefile column instead of reading just DHSID and the coordinates. Defaults to False
     
     Returns:
-        Geopandas.GeoDataFrame: a GeoDataFrame with all of the shapefile data plus a column ('Station Indices') containing a list of relevant indicies of the precip file data over which to search
+        DataFrame: a DataFrame with DHSID (if the shapefile has a .dbf), LATNUM and LONGNUM (or, with full_geodataframe, a GeoDataFrame with all of the shapefile data) plus a column ('Station Indices') containing a list of relevant indicies of the precip file data over which to search and a column ('Station Distances') with the distance (in km) to each of those stations
     '''
+    import pandas as pd
+    from tqdm import tqdm as progress
     # import shapefile
-    gdf = gpd.read_file(file_path)
-    # only take the first ten rows if testing (for speed)
+    if full_geodataframe:
+        import geopandas as gpd
+        gdf = gpd.read_file(file_path)
+        latitudes, longitudes = gdf.geometry.y.to_numpy(), gdf.geometry.x.to_numpy()
+    else:
+        dhsids, latitudes, longitudes = clusterLocations(file_path)
+        gdf = pd.DataFrame({'LATNUM': latitudes, 'LONGNUM': longitudes})
+        if dhsids is not None:
+            gdf.insert(0, 'DHSID', dhsids)
+    # only take the first hundred rows if testing (for speed)
     if testing:
         gdf = gdf.iloc[:100]
-    # create a list of shapely.geometry.Point objects for distance comparison
+        latitudes, longitudes = latitudes[:100], longitudes[:100]
+    # create a list of (latitude, longitude) tuples for distance comparison
     latlong_coord_tuples = [(coord_list[1], coord_list[0]) for coord_list in station_coords]
     # find the distance between center coord and every station (print out progress bar)
-    alldist = [pointDist(geom, lst, index) for index, (geom, lst) in progress(enumerate(zip(gdf['geometry'], itertools.repeat(latlong_coord_tuples))), total=len(gdf['geometry']), desc='Importing shapefile')]
+    alldist = [pointDist(latitude, longitude, latlong_coord_tuples, index) for index, (latitude, longitude) in progress(enumerate(zip(latitudes.tolist(), longitudes.tolist())), total=len(latitudes), desc='Importing shapefile')]
     if cmd_args.determine_distance: return alldist
-    # create a new column and assign it the relevant station indices
+    # create a new column and assign it the relevant station indices. The distances are kept so the stations can be weighted
     monitor_stations = [[index for index, dist in enumerate(row) if dist <= cmd_args.distance] for row in alldist]
     gdf['Station Indices'] = monitor_stations
+    gdf['Station Distances'] = [[row[index] for index in index_list] for row, index_list in zip(alldist, monitor_stations)]
 
     return gdf
 
-def precipFileParser(file_path, months, sum_rainfall=True, return_coords=False):
+def precipFileParser(file_path, months, sum_rainfall=True, return_coords=False, raw_file_contents=None):
     '''This file pulls out the rainfall data in a specific precip.YYYY file.
     
     Args:
@@ -98,6 +430,7 @@ def precipFileParser(file_path, months, sum_rainfall=True, return_coords=False):
         months (list): a two-element list of the numeric value of the start month and the numeric value of the end month
         sum_rainfall (bool, optional): whether or not to sum the rainfall data. Defaults to True
         return_coords (bool, optional): whether to return rainfall data or coordinate values. Defaults to False (data returned).
+        raw_file_contents (str, optional): the text of the file if it has already been read (e.g. out of an archive by readPrecipFiles()). Defaults to None (the file is read from file_path).
     
     Returns:
         list: if return_coords is passed as True, the return value will be a two-dimentional list of the form [[x1, y1], [x2, y2], ...].
@@ -112,8 +445,10 @@ def precipFileParser(file_path, months, sum_rainfall=True, return_coords=False):
     if not isinstance(return_coords, bool): raise TypeError(f'return_coords must be a boolean. You passed a {type(return_coords)}.')
 
     # bring in file
-    with open(file_path, 'r') as fp:
-        raw_file_contents = fp.read()
+    if raw_file_contents is None:
+        opener = gzip.open if file_path.endswith('.gz') else open
+        with opener(file_path, 'rt') as fp:
+            raw_file_contents = fp.read()
     file_contents = raw_file_contents.split('\n')                   # create rows
     # return coords if that's the desired item
     if return_coords:
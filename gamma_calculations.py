@@ -6,48 +6,218 @@
 import os
 import json
 import argparse
-import pandas as pd
-import scipy.stats as stats
-from tqdm import tqdm as progress
 
-def percentile(data_list):
-    '''This function calculates a percentile value in a fitted gamma distribution.
+def gammaFit(data_list):
+    '''This function fits a gamma distribution to a list of data.
     
     Args:
-        data_list (list): a list of data across which to fit the gamma distribution. The last value in the list will not be included in the fitting process and will be used as the target value to find the percentile.
+        data_list (list): a list of data across which to fit the gamma distribution.
     
     Returns:
-        TYPE: DESCRIPTION
+        tuple: the fitted shape (alpha), location, and scale (beta)
     '''
-    target_value = data_list.pop()  # take the target value out of the data list
-    fit_alpha, fit_loc, fit_beta=stats.gamma.fit(data_list)
+    import numpy as np
+    import scipy.stats as stats
+    fit_alpha, fit_loc, fit_beta = stats.gamma.fit(np.asarray(data_list, dtype=np.float64))
 
-    return stats.gamma.cdf(target_value, fit_alpha, loc=fit_loc, scale=fit_beta)
+    return fit_alpha, fit_loc, fit_beta
 
-def sumSlicing(sum_list, len_years, verbose=False):
-    '''This function generates all percentiles across a list.
+def percentiles(target_values, fits, table=None):
+    '''This function calculates the percentiles of many target values in one call.
+    
+    Args:
+        target_values (array-like): the values whose percentiles are wanted
+        fits (array-like): one (alpha, loc, beta) row per target value. Returned by windowFits()
+        table (GammaCDFTable, optional): if passed, the percentiles are interpolated from this table instead of being evaluated exactly
+    
+    Returns:
+        np.array: the percentiles
+    '''
+    import numpy as np
+    import scipy.stats as stats
+    target_values = np.asarray(target_values, dtype=np.float64)
+    fits = np.asarray(fits, dtype=np.float64).reshape(-1, 3)
+    if table is not None:
+        return table(target_values, fits[:, 0], fits[:, 1], fits[:, 2])
+
+    return stats.gamma.cdf(target_values, fits[:, 0], loc=fits[:, 1], scale=fits[:, 2])
+
+class GammaCDFTable():
+    '''An interpolated lookup table of the regularized lower incomplete gamma function P(alpha, z), which is the gamma cdf.
+    The rows are a log-spaced grid of shape parameters spanning the ones passed in. Along each row z is replaced by its
+    Wilson-Hilferty normal score, which puts every alpha on the same smooth scale. Both grids are regular, so evaluating
+    millions of percentiles is index arithmetic, a gather, and a bilinear interpolation.
+    The normal score breaks down for small shapes (P(alpha, z) is too steep near z = 0), so shapes below alpha_cutoff are
+    evaluated exactly. Above it the interpolation error is below 1e-5.
+    '''
+
+    u_min = -10.
+    u_max = 10.
+    alpha_cutoff = 1.
+    min_size = 1_000_000                # below this many percentiles building the table costs more than it saves
+
+    def __init__(self, alphas, alpha_points=256, u_points=2048):
+        '''
+        Args:
+            alphas (array-like): the shape parameters the table will be used for. Only their range matters, so repeated shapes cost nothing.
+            alpha_points (int, optional): the number of rows. Defaults to 256
+            u_points (int, optional): the number of points along each row. Defaults to 2048
+        '''
+        import numpy as np
+        import scipy.special as special
+        alphas = np.maximum(np.asarray(alphas, dtype=np.float64), GammaCDFTable.alpha_cutoff)
+        self.log_a_min = np.log(alphas.min())
+        self.log_a_max = max(np.log(alphas.max()), self.log_a_min + 1e-6)      # so there is always a pair of rows to interpolate between
+        self.alphas = np.exp(np.linspace(self.log_a_min, self.log_a_max, alpha_points))
+        self.alpha_points = alpha_points
+        self.u_points = u_points
+        u = np.linspace(GammaCDFTable.u_min, GammaCDFTable.u_max, u_points)
+        self.values = special.gammainc(self.alphas[:, None], GammaCDFTable.inverseScore(u[None, :], self.alphas[:, None])).ravel()
+
+    @staticmethod
+    def score(z, alphas):
+        '''The Wilson-Hilferty normal score of z under a gamma distribution with shape alpha (and scale 1)'''
+        import numpy as np
+        return (np.cbrt(z / alphas) - 1 + 1 / (9 * alphas)) * np.sqrt(9 * alphas)
+
+    @staticmethod
+    def inverseScore(u, alphas):
+        '''The z whose Wilson-Hilferty normal score is u'''
+        import numpy as np
+        return alphas * np.maximum(u / np.sqrt(9 * alphas) + 1 - 1 / (9 * alphas), 0) ** 3
+
+    def __call__(self, target_values, alphas, locs, scales):
+        '''This function evaluates the gamma cdf for arrays of target values and fitted parameters.
+        
+        Args:
+            target_values (np.array): the values whose percentiles are wanted
+            alphas (np.array): the fitted shapes
+            locs (np.array): the fitted locations
+            scales (np.array): the fitted scales
+        
+        Returns:
+            np.array: the interpolated percentiles
+        '''
+        import numpy as np
+        import scipy.special as special
+        alphas = np.asarray(alphas, dtype=np.float64)
+        z = np.maximum((np.asarray(target_values, dtype=np.float64) - locs) / scales, 0)
+        small = alphas < GammaCDFTable.alpha_cutoff
+        table_alphas = np.maximum(alphas, GammaCDFTable.alpha_cutoff)
+        # fractional position along the rows
+        position = (GammaCDFTable.score(z, table_alphas) - GammaCDFTable.u_min) * ((self.u_points - 1) / (GammaCDFTable.u_max - GammaCDFTable.u_min))
+        np.clip(position, 0, self.u_points - 1, out=position)
+        u_index = np.minimum(position.astype(np.int64), self.u_points - 2)
+        u_weight = position - u_index
+        # fractional position between the rows
+        a_position = (np.log(table_alphas) - self.log_a_min) * ((self.alpha_points - 1) / (self.log_a_max - self.log_a_min))
+        np.clip(a_position, 0, self.alpha_points - 1, out=a_position)
+        a_index = np.minimum(a_position.astype(np.int64), self.alpha_points - 2)
+        a_weight = a_position - a_index
+        # bilinear interpolation with flat gathers
+        flat = a_index * self.u_points + u_index
+        lower = self.values.take(flat)
+        lower += (self.values.take(flat + 1) - lower) * u_weight
+        flat += self.u_points
+        upper = self.values.take(flat)
+        upper += (self.values.take(flat + 1) - upper) * u_weight
+
+        lower += (upper - lower) * a_weight
+        percentile_values = np.where(z > 0, lower, 0.)              # P(alpha, z) is steepest at z = 0 so it is set exactly
+        if small.any():
+            percentile_values[small] = special.gammainc(alphas[small], z[small])
+
+        return percentile_values
+
+    def maxError(self, target_values, fits, sample_size=10_000, seed=0):
+        '''This function compares the table against the exact gamma cdf on a random sample of the percentiles it is about to calculate.
+        
+        Args:
+            target_values (np.array): the values whose percentiles are wanted
+            fits (np.array): one (alpha, loc, beta) row per target value
+            sample_size (int, optional): how many percentiles to check. Defaults to 10,000
+            seed (int, optional): the seed of the sample. Defaults to 0
+        
+        Returns:
+            float: the largest absolute difference
+        '''
+        import numpy as np
+        import scipy.stats as stats
+        rows = np.random.default_rng(seed).choice(len(target_values), size=min(sample_size, len(target_values)), replace=False)
+        sample = fits[rows]
+        exact = stats.gamma.cdf(target_values[rows], sample[:, 0], loc=sample[:, 1], scale=sample[:, 2])
+
+        return float(np.abs(self(target_values[rows], sample[:, 0], sample[:, 1], sample[:, 2]) - exact).max()) if len(rows) else 0.
+
+def windowFits(sum_list, len_years, verbose=False):
+    '''This function fits a gamma distribution to every window across a list.
     
     Args:
         sum_list (list): a list containing all the rainfall sum data.
         len_years (int): how many years to fit a gamma distribution
+        verbose (bool, optional): whether or not to see the intermediate progress bar. Defaults to False
     
     Returns:
-        list: a list of percentiles fitted to a gamma distribution
+        tuple: the target values (the year after each window) and a list of (alpha, loc, beta) fits, one per window
     '''
+    from tqdm import tqdm as progress
     if verbose: pbar = progress(total=len(sum_list)-len_years, leave=False)     # establish a nice progress bar
     leading_pointer = 0
     okazaki_pointer = len_years + 1
-    percentile_list = []
+    target_values = []
+    fits = []
     while okazaki_pointer <= len(sum_list):                         # iterate over every slice of the list that allows for adequate length
         data = sum_list[leading_pointer:okazaki_pointer]
-        temp = percentile(data)
-        percentile_list.append(temp)
+        target_values.append(data[-1])                              # the target value is left out of the fit
+        fits.append(gammaFit(data[:-1]))
         leading_pointer += 1
         okazaki_pointer += 1
         if verbose: pbar.update(1)  # update progress bar
     if verbose: pbar.close()
 
-    return percentile_list
+    return target_values, fits
+
+def windowPercentiles(sum_list, len_years, target_indices):
+    '''This function calculates the percentiles for only some of the windows across a list.
+    
+    Args:
+        sum_list (list): a list containing all the rainfall sum data.
+        len_years (int): how many years to fit a gamma distribution
+        target_indices (list): the indices in sum_list of the years whose percentile is wanted. Indices without len_years of history before them are skipped.
+    
+    Returns:
+        dict: a dict mapping each target index to its percentile fitted to a gamma distribution
+    '''
+    target_indices = [index for index in target_indices if len_years <= index < len(sum_list)]
+    if not target_indices:
+        return {}
+    # same windows windowFits() uses
+    fits = [gammaFit(sum_list[target_index - len_years:target_index]) for target_index in target_indices]
+    window_percentiles = percentiles([sum_list[target_index] for target_index in target_indices], fits)
+
+    return dict(zip(target_indices, window_percentiles.tolist()))
+
+def lookupTable(target_values, fits, tolerance=1e-4):
+    '''This function builds a GammaCDFTable for a run, if it is worth it and accurate enough
+    
+    Args:
+        target_values (np.array): the values whose percentiles are wanted
+        fits (np.array): one (alpha, loc, beta) row per target value
+        tolerance (float, optional): the largest error allowed against the exact gamma cdf on a sample of the run. Defaults to 1e-4
+    
+    Returns:
+        GammaCDFTable: the table, or None if the percentiles should be evaluated exactly
+    '''
+    if len(target_values) < GammaCDFTable.min_size:
+        print(f'Only {len(target_values)} percentiles to calculate. Evaluating them exactly is faster than building the lookup table.')
+        return None
+    table = GammaCDFTable(fits[:, 0])
+    error = table.maxError(target_values, fits)
+    if error > tolerance:
+        print(f'The lookup table was off by up to {error:.3g} on a sample of the percentiles. Evaluating them exactly instead.')
+        return None
+
+    return table
 
 def commandLineParser():
     '''This function parses the command line arguments
@@ -60,13 +230,29 @@ def commandLineParser():
     parser.add_argument('len_years', type=int, help='the number of years to use to fit each gamma distribution.')
     parser.add_argument('--verbose', '-v', action='store_true', help='whether or not to see the intermediate progress bar')
     parser.add_argument('--testing', '-t', action='store_true', help='whether or not to see the intermediate progress bar')
+    parser.add_argument('--lookup_table', action='store_true', help='interpolate the percentiles from a precomputed table of the incomplete gamma function instead of evaluating each one exactly. Only used for runs of a million or more percentiles, and only if it matches the exact cdf to 1e-4 on a sample of them.')
     args = parser.parse_args()
 
     return args
 
 def body(sum_list, cmd_args):
-    # calculate percentiles
-    rainfall_percentiles = [sumSlicing(rainfall_sum, cmd_args.len_years, cmd_args.verbose) for rainfall_sum in progress(sum_list, desc='Calculating Percentiles')]
+    import numpy as np
+    from tqdm import tqdm as progress
+    # fit every window
+    location_fits = [windowFits(rainfall_sum, cmd_args.len_years, cmd_args.verbose) for rainfall_sum in progress(sum_list, desc='Calculating Percentiles')]
+    target_values = np.concatenate([np.asarray(targets, dtype=np.float64) for targets, _ in location_fits])
+    fits = np.concatenate([np.asarray(fit, dtype=np.float64).reshape(-1, 3) for _, fit in location_fits])
+    # evaluate every percentile at once
+    table = lookupTable(target_values, fits) if getattr(cmd_args, 'lookup_table', False) else None
+    flat_percentiles = percentiles(target_values, fits, table)
+    split_points = np.cumsum([len(targets) for targets, _ in location_fits])[:-1]
+    if getattr(cmd_args, 'compact', False):
+        import compact_storage as cs
+        stored_percentiles = flat_percentiles.astype(np.float32)    # only the stored percentiles are float32; the fits above are float64
+        cs.accuracyReport('Percentiles (float32 vs float64)', flat_percentiles, stored_percentiles, getattr(cmd_args, 'thresholds', None))
+        rainfall_percentiles = list(np.split(stored_percentiles, split_points))
+    else:
+        rainfall_percentiles = [location.tolist() for location in np.split(flat_percentiles, split_points)]
     if cmd_args.verbose or __name__ == '__main__':
         # print out year range
         _, columns = os.popen('stty size', 'r').read().split()
@@ -79,6 +265,7 @@ def body(sum_list, cmd_args):
 def main():
     # import needed materials
     cmd_args = commandLineParser()
+    import pandas as pd
     df = pd.read_csv(cmd_args.file_path)
     # just take the rainfall totals
     rainfall_sums = df['Rainfall Totals'].tolist()
@@ -3,45 +3,302 @@
 # Written for research for Professor Daniel LaFave at Colby College
 #
 
+import os
+import re
+import json
 import argparse
-import pandas as pd
-from lifelines import CoxPHFitter
+import rainfall_store
+
+# set in each pool worker by attachSharedData()
+_shared = {}
 
 def commandLineParser():
     '''This function parses the command line arguments
-    
+
     Returns:
         argparse.namespace: an argparse namespace representing the command line arguments
     '''
     parser = argparse.ArgumentParser()
-    parser.add_argument('rainfall_data', type=str, help='the path to the csv containing the rainfall data.')
+    parser.add_argument('rainfall_data', type=str, help='the path to the csv containing the rainfall data. It is indexed into <rainfall_data>.store.npz the first time (and whenever the csv changes).')
     parser.add_argument('DHS_data', type=str, help='the path to the csv containing the DHS survey data.')
+    parser.add_argument('--specifications', '-s', type=str, help='the path to a json file with a list of regression specifications. If not passed, one regression on every column is printed.')
+    parser.add_argument('--bootstrap', '-b', type=int, default=0, help='the number of bootstrap resamples used for the confidence intervals of each specification. Defaults to 0')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of processes used to run the fits. Defaults to the number of cpus.')
+    parser.add_argument('--seed', type=int, default=0, help='the seed for the bootstrap resamples. Defaults to 0')
+    parser.add_argument('--compact', action='store_true', help='read the DHS csv with DHSID and IDHSPID coded as int32, Year as int16 and float columns as float32 (other columns, such as the event columns, are left as they are), and join the rainfall data on the codes. Reports the memory saved.')
+    parser.add_argument('--output_csv', type=str, default='hazard_results.csv', help='where to write the results of the specifications. Defaults to hazard_results.csv')
     args = parser.parse_args()
 
     return args
 
+def shockName(shock, lag):
+    '''The name of a (possibly lagged) shock column
+
+    Args:
+        shock (str): the name of the shock column in the rainfall data. e.g. '<5%-ile'
+        lag (int): how many years the shock is lagged
+
+    Returns:
+        str: the column name
+    '''
+    return shock if lag == 0 else f'{shock} (lag {lag})'
+
+def shockColumns(columns):
+    '''This function finds the drought columns of the rainfall data, whatever thresholds it was built with
+
+    Args:
+        columns (iterable): the column names of the output of create_rainfall_data.py. e.g. RainfallStore.columns
+
+    Returns:
+        list: the drought column names. e.g. ['<5%-ile', '<10%-ile', '<15%-ile']
+    '''
+    return [column for column in columns if re.fullmatch(r'<.+%-ile', column)]
+
+def mergeData(store, mother_df, lags=(0,), dictionary=None):
+    '''This function attaches the drought shocks to the mother data
+
+    Args:
+        store (RainfallStore): the indexed output of create_rainfall_data.py returned by rainfall_store.readStore()
+        mother_df (pd.DataFrame): the output of mother_parsers.py --hazard_regressions
+        lags (iterable, optional): the lags of the shocks to attach. A lag of 1 attaches the shock of the year before 'Year'. Defaults to (0,)
+        dictionary (dict, optional): the key dictionary of mother_df's integer-coded DHSIDs when it was read with --compact. Defaults to None
+
+    Returns:
+        pd.DataFrame: the mother data indexed by IDHSPID with the shocks as zeros and ones and DHSID/Year dropped
+    '''
+    import numpy as np
+    shock_columns = shockColumns(store.columns)
+    merged = mother_df.drop(columns=['DHSID', 'Year']).set_index('IDHSPID')
+    years = mother_df['Year'].to_numpy(dtype=np.int64)
+    for lag in sorted(set(lags)):
+        offsets = store.offsets(mother_df['DHSID'].to_numpy(), years - lag, dictionary)
+        for shock in shock_columns:
+            merged[shockName(shock, lag)] = store.gather(shock, offsets).astype(int)       # years without rainfall data count as no shock
+
+    return merged
+
+def readSpecifications(file_path):
+    '''This function reads the regression specifications. The file holds a json list like
+        [{"name": "5%, last year, coast", "shocks": ["<5%-ile"], "lag": 1, "controls": [], "subset": {"column": "region", "values": ["coast"]}}, ...]
+    Only "name" and "shocks" are required.
+
+    Args:
+        file_path (str): the path to the json file
+
+    Returns:
+        list: a list of dicts with every key filled in
+    '''
+    with open(file_path, 'r') as f:
+        specifications = json.load(f)
+    if not isinstance(specifications, list): raise TypeError(f'the specifications must be a json list. You passed a {type(specifications)}.')
+    for spec in specifications:
+        if 'name' not in spec or 'shocks' not in spec: raise ValueError(f'every specification needs a "name" and "shocks". You passed {spec}.')
+        spec.setdefault('lag', 0)
+        spec.setdefault('controls', [])
+        spec.setdefault('subset', None)
+
+    return specifications
+
+def specificationTable(mother_df, store, specifications, dictionary=None):
+    '''This function builds the one numeric table every specification is fitted from
+
+    Args:
+        mother_df (pd.DataFrame): the output of mother_parsers.py --hazard_regressions
+        store (RainfallStore): the indexed output of create_rainfall_data.py returned by rainfall_store.readStore()
+        specifications (list): the list returned by readSpecifications()
+        dictionary (dict, optional): the key dictionary of mother_df's integer-coded DHSIDs when it was read with --compact. Defaults to None
+
+    Returns:
+        tuple: the float64 table as a np.array, its column names, and the specifications with each subset translated into the integer codes of its column
+
+    Raises:
+        ValueError: if a shock is not in the rainfall data, a control or subset column is not in the DHS data, or a control is not numeric
+    '''
+    import numpy as np
+    import pandas as pd
+    for spec in specifications:
+        unknown = [shock for shock in spec['shocks'] if shock not in shockColumns(store.columns)]
+        if unknown: raise ValueError(f'shocks must be in {shockColumns(store.columns)}. You passed {unknown}.')
+        missing = [column for column in spec['controls'] + ([spec['subset']['column']] if spec['subset'] is not None else []) if column not in mother_df.columns]
+        if missing: raise ValueError(f'{missing} (used by "{spec["name"]}") are not columns of the DHS data. Pass them through with mother_parsers.py --keep_columns.')
+        not_numeric = [column for column in spec['controls'] if not pd.api.types.is_numeric_dtype(mother_df[column])]
+        if not_numeric: raise ValueError(f'the controls {not_numeric} (used by "{spec["name"]}") are not numeric. Use them as a subset instead, or code them as numbers.')
+    merged = mergeData(store, mother_df, [spec['lag'] for spec in specifications], dictionary)
+    needed = ['Event Time', 'Event Occured']
+    for spec in specifications:
+        needed += [shockName(shock, spec['lag']) for shock in spec['shocks']] + spec['controls']
+    needed = list(dict.fromkeys(needed))
+    table = merged[needed].copy()
+    # subset columns may hold strings (e.g. region names) so their integer codes get a column of their own. The column itself may also be a control
+    coded_specs = []
+    for spec in specifications:
+        spec = dict(spec)
+        if spec['subset'] is not None:
+            column = spec['subset']['column']
+            code_column = f'_{column} codes'
+            codes, uniques = pd.factorize(merged[column])
+            if code_column not in table.columns:
+                table[code_column] = codes
+                needed.append(code_column)
+            spec['subset'] = {'column': code_column, 'codes': [int(code) for code, value in enumerate(uniques) if value in spec['subset']['values']]}
+        coded_specs.append(spec)
+
+    return np.ascontiguousarray(table.to_numpy(dtype=np.float64)), needed, coded_specs
+
+def attachSharedData(shm_name, shape, columns):
+    '''Pool initializer. Attaches every worker to the table in shared memory so that tasks never copy it.
+
+    Args:
+        shm_name (str): the name of the multiprocessing.shared_memory.SharedMemory block
+        shape (tuple): the shape of the table
+        columns (list): the column names of the table
+    '''
+    import numpy as np
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shared['shm'] = shm                                # keep the block alive as long as the worker
+    _shared['table'] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    _shared['columns'] = columns
+
+def fitSpecification(spec, seeds):
+    '''This function fits one specification on the full data (seed None) or on bootstrap resamples of it
+
+    Args:
+        spec (dict): a specification from specificationTable()
+        seeds (list): [None] for the full-data fit, otherwise one seed per bootstrap resample
+
+    Returns:
+        list: one dict per seed with the coefficients (and for the full-data fit the standard errors, p-values and sizes)
+    '''
+    import numpy as np
+    import pandas as pd
+    from lifelines import CoxPHFitter
+    from lifelines.exceptions import ConvergenceError
+    table = _shared['table']
+    columns = _shared['columns']
+    covariates = [shockName(shock, spec['lag']) for shock in spec['shocks']] + spec['controls']
+    rows = np.arange(table.shape[0])
+    if spec['subset'] is not None:
+        rows = rows[np.isin(table[:, columns.index(spec['subset']['column'])], spec['subset']['codes'])]
+    column_indices = [columns.index(column) for column in ['Event Time', 'Event Occured'] + covariates]
+    results = []
+    for seed in seeds:
+        sample = rows if seed is None else np.random.default_rng(seed).choice(rows, size=len(rows), replace=True)
+        df = pd.DataFrame(table[np.ix_(sample, column_indices)], columns=['Event Time', 'Event Occured'] + covariates)
+        try:
+            cph = CoxPHFitter()
+            cph.fit(df, 'Event Time', event_col='Event Occured')
+        except (ConvergenceError, np.linalg.LinAlgError, ValueError):
+            if seed is None: raise
+            continue                                    # some resamples are degenerate; they are left out of the intervals
+        result = {'coef': cph.params_.to_dict()}
+        if seed is None:
+            result['se'] = cph.standard_errors_.to_dict()
+            result['p'] = cph.summary['p'].to_dict()
+            result['n'] = len(df)
+            result['events'] = int(df['Event Occured'].sum())
+        results.append(result)
+
+    return results
+
+def runSpecifications(table, columns, specifications, bootstrap=0, workers=None, seed=0, chunk_size=25):
+    '''This function runs every specification (and its bootstrap resamples) across a process pool
+
+    Args:
+        table (np.array): the table returned by specificationTable()
+        columns (list): the column names of the table
+        specifications (list): the coded specifications returned by specificationTable()
+        bootstrap (int, optional): the number of bootstrap resamples per specification. Defaults to 0
+        workers (int, optional): the number of processes. Defaults to the number of cpus.
+        seed (int, optional): the seed the bootstrap seeds are drawn from. Defaults to 0
+        chunk_size (int, optional): how many bootstrap fits each task runs. Defaults to 25
+
+    Returns:
+        pd.DataFrame: one row per specification and covariate
+    '''
+    import numpy as np
+    import pandas as pd
+    from multiprocessing import shared_memory
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm as progress
+    # put the table in shared memory once
+    shm = shared_memory.SharedMemory(create=True, size=max(table.nbytes, 1))
+    try:
+        np.ndarray(table.shape, dtype=np.float64, buffer=shm.buf)[:] = table
+        seed_sequence = np.random.SeedSequence(seed)
+        with ProcessPoolExecutor(max_workers=workers, initializer=attachSharedData, initargs=(shm.name, table.shape, columns)) as pool:
+            futures = []
+            for spec_index, spec in enumerate(specifications):
+                futures.append((spec_index, pool.submit(fitSpecification, spec, [None])))
+                boot_seeds = [int(child.generate_state(1)[0]) for child in seed_sequence.spawn(bootstrap)]
+                for start in range(0, bootstrap, chunk_size):
+                    futures.append((spec_index, pool.submit(fitSpecification, spec, boot_seeds[start:start + chunk_size])))
+            point_fits = {}
+            boot_fits = {spec_index: [] for spec_index in range(len(specifications))}
+            for spec_index, future in progress(futures, desc='Fitting specifications'):
+                for result in future.result():
+                    if 'se' in result:
+                        point_fits[spec_index] = result
+                    else:
+                        boot_fits[spec_index].append(result['coef'])
+    finally:
+        shm.close()
+        shm.unlink()
+    # consolidate
+    rows = []
+    for spec_index, spec in enumerate(specifications):
+        point = point_fits[spec_index]
+        for covariate, coef in point['coef'].items():
+            boot = [fit[covariate] for fit in boot_fits[spec_index]]
+            rows.append({
+                'Specification': spec['name'],
+                'Covariate': covariate,
+                'Coefficient': coef,
+                'Hazard Ratio': np.exp(coef),
+                'Std. Error': point['se'][covariate],
+                'p': point['p'][covariate],
+                'Bootstrap 2.5%': np.percentile(boot, 2.5) if boot else np.nan,
+                'Bootstrap 97.5%': np.percentile(boot, 97.5) if boot else np.nan,
+                'Bootstrap Fits': len(boot),
+                'N': point['n'],
+                'Events': point['events'],
+            })
+
+    return pd.DataFrame(rows)
+
 def main():
     # get command line arguments
     cmd_args = commandLineParser()
-    # import data (mother/rain)
-    rainfall_df = pd.read_csv(cmd_args.rainfall_data)
-    mother_df = pd.read_csv(cmd_args.DHS_data)
+    import pandas as pd
+    # import data (mother/rain). The rainfall csv is only read the first time; after that its store is used
+    store = rainfall_store.readStore(cmd_args.rainfall_data)
+    dictionary = None
+    if cmd_args.compact:
+        import compact_storage as cs
+        dictionary = cs.keyDictionary()
+        mother_df = cs.readCompactCsv(cmd_args.DHS_data, dictionary)
+        cs.memoryReport('Mother data', cs.frameBytes(cs.plainFrame(mother_df, dictionary)), cs.frameBytes(mother_df))
+    else:
+        mother_df = pd.read_csv(cmd_args.DHS_data)
+    if cmd_args.specifications:
+        specifications = readSpecifications(cmd_args.specifications)
+        table, columns, specifications = specificationTable(mother_df, store, specifications, dictionary)
+        results = runSpecifications(table, columns, specifications, cmd_args.bootstrap, cmd_args.workers, cmd_args.seed)
+        results.to_csv(cmd_args.output_csv, index=False)
+        print(f'Wrote {len(results)} rows for {len(specifications)} specifications to {cmd_args.output_csv}')
+        return
     # get relevant data from rain data
-    merged = pd.merge(mother_df, rainfall_df, on=['DHSID', 'Year'], how='left')
-    merged.set_index('IDHSPID', inplace=True)
-    # drop unneeded columns
-    drop_columns = ['DHSID', 'Year', r'%-ile', 'Total Rainfall (mm)']
-    for column in merged.columns:
-        if column in drop_columns:
-            merged.drop(column, axis=1, inplace=True)
-    # change Bools into ones or zeros
-    for column in [r'<5%-ile', r'<10%-ile', r'<15%-ile']:
-        merged[column] = (merged[column] == True).astype(int)
+    merged = mergeData(store, mother_df, dictionary=dictionary)
+    # columns passed through by mother_parsers.py --keep_columns are only used by --specifications
+    columns = ['Event Time', 'Event Occured'] + shockColumns(store.columns)
+    passed_through = [column for column in merged.columns if column not in columns]
+    if passed_through: print(f'Leaving {passed_through} out of the regression. Use them as controls or subsets with --specifications.')
     # regressions
+    from lifelines import CoxPHFitter
     cph = CoxPHFitter()
-    cph.fit(merged, 'Event Time', event_col='Event Occured')
+    cph.fit(merged[columns], 'Event Time', event_col='Event Occured')
     # display results
     cph.print_summary()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
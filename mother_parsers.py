@@ -3,78 +3,11 @@
 # Written for research for Professor Daniel LaFave at Colby College
 #
 
+import os
 import argparse
 import itertools
-import numpy as np
-import pandas as pd
-from tqdm import tqdm as progress
-
-class Mother():
-
-    master_df = None
-    collection_year = None
-
-    def __init__(self, id_num):
-        self.id_num = id_num
-        self.df_subset = Mother.master_df.loc[Mother.master_df['idhspid'] == id_num]                 # the relevant rows of the df
-        self.dhsid = self.df_subset['dhsid'].iloc[0]
-        self.birth_year = self.df_subset['birthyear'].iloc[0]
-        self.collected_range = list(range(self.birth_year + 14, Mother.collection_year + 1))        # over what years was this mother surveyed
-        self.mother_age = [dyear - self.birth_year for dyear in self.collected_range]               # how old was she
-        self.gave_birth = self.df_subset['kidbirthyr'].tolist()                                     # what years did she give birth
-        self.kids = [True if year in self.gave_birth else False for year in self.collected_range]   # make a list of booleans for births
-
-    def genDataArray(self):
-        '''Generate an array containing all the information pertaining to this mother.
-        
-        Returns:
-            np.array: DHSCLUST, Mother ID, Year, Age, Birth in an array. Shape is len(collected_range) by 5
-        '''
-        # figure out how long
-        final_length = len(self.collected_range)
-        # create the constant lists
-        clust = list(itertools.repeat(self.dhsid, final_length))
-        id_num = list(itertools.repeat(self.id_num, final_length))
-        # create an array and reflect it with np.array.T
-        data = np.array([clust, id_num, self.collected_range, self.mother_age, self.kids]).T
-        
-        return data
-
-    def genHazardArray(self):
-        '''Generate an array containing all the information pertaining to this mother.
-        
-        Returns:
-            np.array: Mother ID, event_time, event_occurred, dhsid, event_year. Shape is 1 by 5
-        '''
-        # get the event time and censorship status
-        try:
-            event_index = self.kids.index(True)
-            event_time = event_index + 1
-            event_occured = 1
-            event_year = self.collected_range[event_index] - 1
-        except ValueError:
-            event_time = len(self.kids)
-            event_occured = 0
-            event_year = Mother.collection_year - 1
-
-        # create array
-        data = np.array([self.id_num, event_time, event_occured, self.dhsid, event_year])
-
-        return data
-
-    def __repr__(self):
-        return f'Mother({self.id_num})'
-
-    def __str__(self):
-        output = ''
-        output += f'id_num = {self.id_num}\n'
-        output += f'dhsid = {self.dhsid}\n'
-        output += f'birth year = {self.birth_year}\n'
-        output += f'collected_range = {self.collected_range}\n'
-        output += f'mother age = {self.mother_age}\n'
-        output += f'give birth years = {self.gave_birth}'
-
-        return output
+
+SURVEY_DTYPES = {'idhspid': 'int64', 'dhsid': 'str', 'birthyear': 'int16', 'kidbirthyr': 'float32', 'year': 'int16'}     # the only columns read from the extract. kidbirthyr is blank for mothers without children
 
 def commandLineParser():
     '''This function parses the command line arguments
@@ -86,56 +19,210 @@ def commandLineParser():
     parser.add_argument('input_csv', type=str, help='the name of the csv containing the DHS survey data.')
     parser.add_argument('--output_csv', type=str, default='mother_data.csv', help='what to call the output csv file.')
     parser.add_argument('--hazard_regressions', action='store_true', help='whether or not the output will be used to run hazard regressions.')
+    parser.add_argument('--survey_column', type=str, default='sample', help='the column that identifies each survey. Every survey gets its own collection year. Defaults to sample')
+    parser.add_argument('--chunksize', type=int, default=1_000_000, help='how many rows of the extract to read at once. Defaults to 1,000,000')
+    parser.add_argument('--workers', type=int, default=1, help='how many surveys to process in parallel. Defaults to 1')
+    parser.add_argument('--keep_columns', type=str, nargs='+', default=[], help='other columns of the extract to pass through to the output, taken from each mother\'s first row. e.g. region, so hazard_regressions.py can use it as a control or subset.')
     args = parser.parse_args()
 
     return args
 
-def getHazardDataFrame(df):
-    '''Get hazard data
+def firstRows(df):
+    '''Get the first row of every mother, which holds her dhsid and birth year
     
     Args:
         df (Pandas DataFrame): the dataframe containing survey data
     
+    Returns:
+        DataFrame: one row per mother in order of first appearance
+    '''
+    return df.drop_duplicates('idhspid').reset_index(drop=True)
+
+def getHazardDataFrame(df, collection_year=None, keep_columns=()):
+    '''Get hazard data. Each mother is followed from age 14 to the survey, and her event is her first birth; the event year is the year before it (or before the survey if she had none).
+    
+    Args:
+        df (Pandas DataFrame): the dataframe containing survey data for one survey
+        collection_year (int, optional): the year the survey was collected. Defaults to df['year'].iloc[0]
+        keep_columns (iterable, optional): other columns of df to add, taken from each mother's first row. Defaults to ()
+    
     Returns:
         DataFrame: processed DataFrame. Almost ready to use with lifelines.
     '''
-    survey_year = df['year'].iloc[0]
-    Mother.collection_year = survey_year
-    Mother.master_df = df
-    # make a list of all unique mother id
-    id_num_list = df['idhspid'].tolist()
-    id_num_list = list(dict.fromkeys(id_num_list))
-    # create a Mother object for each id
-    mother_list = [Mother(num) for num in progress(id_num_list, desc='Creating mother objects')]
-    # create an array containing all relevant data
-    mother_arrays = [mother.genHazardArray() for mother in mother_list]
-    data = np.column_stack(mother_arrays).T
-    out_df = pd.DataFrame(data=data, columns=['IDHSPID', 'Event Time', 'Event Occured', 'DHSID', 'Year'])
+    import numpy as np
+    import pandas as pd
+    if collection_year is None:
+        collection_year = int(df['year'].iloc[0])
+    mothers = firstRows(df)
+    start_year = mothers['birthyear'].to_numpy(dtype=np.int64) + 14
+    # first birth inside each mother's collected range
+    kid_years = df['kidbirthyr'].to_numpy(dtype=np.float64, na_value=np.nan)
+    row_start = df['idhspid'].map(pd.Series(start_year, index=mothers['idhspid'])).to_numpy(dtype=np.float64)
+    in_range = (kid_years >= row_start) & (kid_years <= collection_year)
+    first_birth = pd.Series(kid_years[in_range]).groupby(df['idhspid'].to_numpy()[in_range]).min()
+    first_birth = mothers['idhspid'].map(first_birth).to_numpy(dtype=np.float64)
+    occured = ~np.isnan(first_birth)
+    event_year = np.where(occured, first_birth - 1, collection_year - 1).astype(np.int64)
+    event_time = np.where(occured, first_birth - start_year + 1, np.maximum(collection_year - start_year + 1, 0)).astype(np.int64)
+    out_df = pd.DataFrame({'IDHSPID': mothers['idhspid'].to_numpy(), 'Event Time': event_time, 'Event Occured': occured.astype(np.int64),
+                           'DHSID': mothers['dhsid'].to_numpy(), 'Year': event_year})
+    for column in keep_columns:
+        out_df[column] = mothers[column].to_numpy()
     
     return out_df
 
+def getPanelDataFrame(df, collection_year=None, keep_columns=()):
+    '''Get panel data. Each mother gets a row for every year from age 14 to the survey with her age and whether she gave birth that year.
+    
+    Args:
+        df (Pandas DataFrame): the dataframe containing survey data for one survey
+        collection_year (int, optional): the year the survey was collected. Defaults to df['year'].iloc[0]
+        keep_columns (iterable, optional): other columns of df to add, taken from each mother's first row. Defaults to ()
+    
+    Returns:
+        DataFrame: one row per mother per year she was surveyed
+    '''
+    import numpy as np
+    import pandas as pd
+    if collection_year is None:
+        collection_year = int(df['year'].iloc[0])
+    mothers = firstRows(df)
+    birth_year = mothers['birthyear'].to_numpy(dtype=np.int64)
+    lengths = np.maximum(collection_year - (birth_year + 14) + 1, 0)
+    # repeat each mother once per year in her collected range
+    mother_index = np.repeat(np.arange(len(mothers)), lengths)
+    offsets = np.arange(len(mother_index)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    years = birth_year[mother_index] + 14 + offsets
+    ids = mothers['idhspid'].to_numpy()[mother_index]
+    births = pd.MultiIndex.from_arrays([df['idhspid'].to_numpy(), df['kidbirthyr'].to_numpy(dtype=np.float64, na_value=np.nan)])
+    out_df = pd.DataFrame({'DHSID': mothers['dhsid'].to_numpy()[mother_index], 'IDHSPID': ids, 'Year': years,
+                           'Mother\'s Age': years - birth_year[mother_index],
+                           'Baby?': pd.MultiIndex.from_arrays([ids, years.astype(np.float64)]).isin(births)})
+    for column in keep_columns:
+        out_df[column] = mothers[column].to_numpy()[mother_index]
+
+    return out_df
+
+def surveyColumn(input_csv, survey_column):
+    '''Work out which column splits the extract into surveys
+    
+    Args:
+        input_csv (str): the csv containing the DHS survey data
+        survey_column (str): the column asked for on the command line
+    
+    Returns:
+        str: survey_column if the extract has it, otherwise 'year' (a single-country extract has one survey per year)
+    '''
+    import pandas as pd
+    header = pd.read_csv(input_csv, nrows=0).columns
+    if survey_column in header:
+        return survey_column
+    print(f'{input_csv} has no {survey_column} column. Treating each year as one survey.')
+
+    return 'year'
+
+def partitionSurveys(input_csv, survey_column, folder, chunksize=1_000_000, keep_columns=()):
+    '''Read the extract in chunks, keeping only the needed columns, and spill the rows of each survey into their own file
+    
+    Args:
+        input_csv (str): the csv containing the DHS survey data
+        survey_column (str): the column that identifies the survey. Returned by surveyColumn()
+        folder (str): the folder in which to write the partitions
+        chunksize (int, optional): how many rows to read at once. Defaults to 1,000,000
+        keep_columns (iterable, optional): other columns to read, with their types inferred. Defaults to ()
+    
+    Returns:
+        list: the paths to the partitions in order of first appearance
+    '''
+    import pickle
+    import pandas as pd
+    from tqdm import tqdm as progress
+    usecols = list(dict.fromkeys(list(SURVEY_DTYPES) + [survey_column] + list(keep_columns)))
+    dtypes = {column: SURVEY_DTYPES.get(column, 'str') for column in usecols if column in SURVEY_DTYPES or column == survey_column}
+    partitions = {}
+    handles = {}
+    try:
+        for chunk in progress(pd.read_csv(input_csv, usecols=usecols, dtype=dtypes, chunksize=chunksize), desc='Partitioning surveys'):
+            missing = chunk[survey_column].isna()
+            if missing.any():
+                raise ValueError(f'{input_csv} has {missing.sum()} rows without a {survey_column} (the first at row {chunk.index[missing.to_numpy()][0] + 2} of the csv). Every row must belong to a survey, so that each mother is processed with the rest of her survey.')
+            for survey, partition in chunk.groupby(survey_column, sort=False):
+                if survey not in handles:
+                    partitions[survey] = os.path.join(folder, f'survey_{len(partitions)}.pkl')
+                    handles[survey] = open(partitions[survey], 'wb')
+                pickle.dump(partition, handles[survey])
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    return list(partitions.values())
+
+def readPartition(path):
+    '''Read back the rows of one survey written by partitionSurveys()
+    
+    Args:
+        path (str): the path to the partition
+    
+    Returns:
+        DataFrame: the survey data
+    '''
+    import pickle
+    import pandas as pd
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunks.append(pickle.load(f))
+            except EOFError:
+                break
+
+    return pd.concat(chunks, ignore_index=True)
+
+def processPartition(path, hazard_regressions=False, keep_columns=()):
+    '''Build the hazard or panel rows for one survey using that survey's own collection year
+    
+    Args:
+        path (str): the path to the partition written by partitionSurveys()
+        hazard_regressions (bool, optional): whether to build hazard rows instead of panel rows. Defaults to False
+        keep_columns (iterable, optional): other columns to pass through. Defaults to ()
+    
+    Returns:
+        DataFrame: the rows for the survey
+    '''
+    df = readPartition(path)
+    if hazard_regressions:
+        return getHazardDataFrame(df, keep_columns=keep_columns)
+
+    return getPanelDataFrame(df, keep_columns=keep_columns)
+
 def main():
+    import tempfile
     # get command-line arguments
     cmd_args = commandLineParser()
-    # assign Class variable to the correct DataFrame
-    input_df = pd.read_csv(cmd_args.input_csv)
-    if cmd_args.hazard_regressions:
-        df = getHazardDataFrame(input_df)
-    else:
-        survey_year = input_df['year'].iloc[0]
-        Mother.collection_year = survey_year
-        Mother.master_df = input_df
-        # make a list of all unique mother id
-        id_num_list = input_df['idhspid'].tolist()
-        id_num_list = list(dict.fromkeys(id_num_list))
-        # create a Mother object for each id
-        mother_list = [Mother(num) for num in progress(id_num_list, desc='Creating mother objects')]
-        # create an array containing all relevant data
-        mother_arrays = [mother.genDataArray() for mother in mother_list]
-        data = np.concatenate(mother_arrays)
-        df = pd.DataFrame(data=data, columns=['DHSID', 'IDHSPID', 'Year', 'Mother\'s Age', 'Baby?'])
-    # make a new DataFrame and export as csv
-    df.to_csv(cmd_args.output_csv, index=False)
+    with tempfile.TemporaryDirectory() as folder:
+        # split the extract into surveys without loading all of it
+        survey_column = surveyColumn(cmd_args.input_csv, cmd_args.survey_column)
+        partitions = partitionSurveys(cmd_args.input_csv, survey_column, folder, cmd_args.chunksize, cmd_args.keep_columns)
+        args = [(path, cmd_args.hazard_regressions, cmd_args.keep_columns) for path in partitions]
+        pool = None
+        try:
+            if cmd_args.workers > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(max_workers=cmd_args.workers)
+                results = pool.map(processPartition, *zip(*args))
+            else:
+                results = itertools.starmap(processPartition, args)
+            # stream each survey to the output csv as soon as it is done
+            from tqdm import tqdm as progress
+            header = True
+            for df in progress(results, total=len(partitions), desc='Processing surveys'):
+                df.to_csv(cmd_args.output_csv, index=False, header=header, mode='w' if header else 'a')
+                header = False
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)          # the workers must be gone before their partitions are deleted
+    if header:
+        raise ValueError(f'{cmd_args.input_csv} contains no survey data.')
 
 if __name__ == '__main__':
     main()
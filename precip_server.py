@@ -0,0 +1,373 @@
+# This script will keep the precip data and station coordinates in shared memory so that every other script can skip parsing the precip files
+# Caleb Bitting (Colby Class of 2023)
+# Written for research for Professor Daniel LaFave at Colby College
+#
+# Start it once (python rainfall_cli.py precip_server) and leave it running. rainfall_sums.importPrecipData() and
+# file_parsers.stationCoords() ask it for their arrays over a Unix socket and map them straight out of shared memory.
+# If it is not running (or cannot answer) they parse the precip files themselves, exactly as before.
+
+import os
+import json
+import stat
+import socket
+import argparse
+import tempfile
+
+SOCKET_ENV = 'RAINFALL_SERVER_SOCKET'       # set this to use a socket other than the default
+_attached = []                              # shared memory blocks this process is attached to. They must outlive the arrays that view them
+
+def socketDirectory():
+    '''A directory only this user can use, for the socket. $XDG_RUNTIME_DIR if it is set, otherwise rainfall_server_<uid> in the temp folder (created with mode 0700)
+
+    Returns:
+        str: the path of the directory
+    '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return runtime_dir
+    directory = os.path.join(tempfile.gettempdir(), f'rainfall_server_{os.getuid()}')
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f'{directory} is not a directory that only this user can use. Remove it or set ${SOCKET_ENV}.')
+
+    return directory
+
+def socketPath(socket_path=None):
+    '''The path of the Unix socket the server listens on
+
+    Args:
+        socket_path (str, optional): an explicit path. Defaults to $RAINFALL_SERVER_SOCKET or rainfall_server.sock in socketDirectory()
+
+    Returns:
+        str: the path
+    '''
+    if socket_path:
+        return socket_path
+
+    return os.environ.get(SOCKET_ENV) or os.path.join(socketDirectory(), 'rainfall_server.sock')
+
+def sourceStamp(precip_source, names):
+    '''The size and modification time of the precip files (or of the archive that holds them). Used to tell whether the arrays the server holds are out of date.
+
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+        names (list): the names of the precip files
+
+    Returns:
+        list: [size, mtime] pairs
+    '''
+    paths = [os.path.join(precip_source, name) for name in names] if os.path.isdir(precip_source) else [precip_source]
+
+    return [[info.st_size, info.st_mtime_ns] for info in map(os.stat, paths)]
+
+def sendRequest(request, socket_path=None):
+    '''This function sends one request to the server
+
+    Args:
+        request (dict): the request. e.g. {'op': 'coords', 'source': '/data/precip', 'year': 1977}
+        socket_path (str, optional): the socket of the server. Defaults to socketPath()
+
+    Returns:
+        dict: the reply, or None if the server is not running
+    '''
+    try:
+        socket_path = socketPath(socket_path)
+    except PermissionError as error:
+        print(f'Not using the precip server: {error}')
+        return None
+    try:
+        owner = os.stat(socket_path).st_uid
+    except FileNotFoundError:
+        return None
+    if owner != os.getuid():
+        print(f'Not using the precip server: {socket_path} belongs to another user.')     # anyone could have put it there, and its replies are trusted
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(1)
+            client.connect(socket_path)
+            client.settimeout(None)                     # the first request for some data waits while the server parses it
+            client.sendall((json.dumps(request) + '\n').encode())
+            with client.makefile('r') as f:
+                reply = f.readline()
+    except OSError:
+        return None
+
+    return json.loads(reply) if reply else None
+
+def attachArray(reply):
+    '''This function maps an array the server holds into this process without copying it
+
+    Args:
+        reply (dict): the reply of the server. Of the form {'shm': name, 'shape': [...], 'dtype': 'float64'}
+
+    Returns:
+        np.array: a read-only view of the shared memory
+    '''
+    import numpy as np
+    from multiprocessing import shared_memory, resource_tracker
+    shm = shared_memory.SharedMemory(name=reply['shm'])
+    resource_tracker.unregister(shm._name, 'shared_memory')    # the block belongs to the server; without this it would be unlinked when this process exits
+    _attached.append(shm)
+    array = np.ndarray(reply['shape'], dtype=reply['dtype'], buffer=shm.buf)
+    array.flags.writeable = False
+
+    return array
+
+def requestArray(request, socket_path=None):
+    '''This function asks the server for an array and attaches to it
+
+    Args:
+        request (dict): the request
+        socket_path (str, optional): the socket of the server. Defaults to socketPath()
+
+    Returns:
+        np.array: the array, or None if the server is not running or could not load it
+    '''
+    reply = sendRequest(request, socket_path)
+    if reply is None:
+        return None
+    if 'error' in reply:
+        print(f'The precip server could not load the data ({reply["error"]}). Reading the precip files directly.')
+        return None
+    try:
+        return attachArray(reply)
+    except (OSError, ValueError):
+        return None
+
+def requestPrecipData(precip_source, names, month_range, socket_path=None):
+    '''This function gets the parsed precip data from the server
+
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+        names (list): the names of the precip files in the order wanted
+        month_range (list): the months across which the rainfall is summed
+        socket_path (str, optional): the socket of the server. Defaults to socketPath()
+
+    Returns:
+        np.array: the rainfall totals (years by stations), or None if the server is not running
+    '''
+    request = {'op': 'precip', 'source': os.path.abspath(precip_source), 'names': list(names), 'month_range': [int(month) for month in month_range]}
+
+    return requestArray(request, socket_path)
+
+def requestStationCoords(precip_source, year=1977, socket_path=None):
+    '''This function gets the coordinates of every precip station from the server
+
+    Args:
+        precip_source (str): the path to a folder of precip files or to an archive of them
+        year (int, optional): the year of the file to read them from. Defaults to 1977
+        socket_path (str, optional): the socket of the server. Defaults to socketPath()
+
+    Returns:
+        np.array: the coordinates (stations by [x, y]), or None if the server is not running
+    '''
+    return requestArray({'op': 'coords', 'source': os.path.abspath(precip_source), 'year': int(year)}, socket_path)
+
+class DataServer():
+    '''The arrays held by the server. Each one is parsed on the first request for it (or at startup) and kept in its own shared memory block.
+    Only the most recently used blocks are kept, so requests for many different subsets of the precip files (e.g. one per update) don't pile up.
+    '''
+
+    def __init__(self, max_blocks=8, max_bytes=None):
+        '''
+        Args:
+            max_blocks (int, optional): how many blocks to keep. Defaults to 8
+            max_bytes (int, optional): how much shared memory the blocks may use together. The block just loaded is always kept. Defaults to no limit
+        '''
+        import threading
+        import collections
+        self.blocks = collections.OrderedDict()     # request key -> (stamp, SharedMemory, shape), least recently used first
+        self.loading = {}                           # request key -> threading.Event set once the request parsing it is done
+        self.lock = threading.Lock()                # guards blocks and loading. Never held while parsing
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+
+    def share(self, key, stamp, load):
+        '''This function returns the block for a key, loading it if it is missing or out of date. Requests for other keys are answered while it loads;
+        requests for the same key wait for it instead of parsing it again.
+
+        Args:
+            key (tuple): what was asked for
+            stamp (list): the sourceStamp() of the files it comes from
+            load (function): parses the array when needed
+
+        Returns:
+            dict: the reply for the client
+        '''
+        import threading
+        import numpy as np
+        from multiprocessing import shared_memory
+        while True:
+            with self.lock:
+                block = self.blocks.get(key)
+                if block is not None and block[0] == stamp:
+                    self.blocks.move_to_end(key)
+                    return {'shm': block[1].name, 'shape': list(block[2]), 'dtype': 'float64'}
+                loaded = self.loading.get(key)
+                if loaded is None:
+                    loaded = self.loading[key] = threading.Event()
+                    break
+            loaded.wait()                               # then check again. If that load failed this request tries it itself
+        try:
+            array = np.ascontiguousarray(load(), dtype=np.float64)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf)[:] = array
+        except BaseException:
+            with self.lock:
+                del self.loading[key]
+            loaded.set()
+            raise
+        with self.lock:
+            if key in self.blocks:
+                self.unlink(self.blocks.pop(key)[1])    # clients that already attached keep their mapping
+            self.blocks[key] = (stamp, shm, array.shape)
+            del self.loading[key]
+            self.evict()
+        loaded.set()
+        print(f'Loaded {key[0]} data from {key[1]} ({array.nbytes / 2**20:.2f} MiB)')
+
+        return {'shm': shm.name, 'shape': list(array.shape), 'dtype': 'float64'}
+
+    def evict(self):
+        '''This function frees the least recently used blocks until the limits are met. Call it with the lock held.'''
+        total_bytes = sum(shm.size for _, shm, _ in self.blocks.values())
+        while len(self.blocks) > 1 and (len(self.blocks) > self.max_blocks or (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            key, (_, shm, _) = self.blocks.popitem(last=False)
+            total_bytes -= shm.size
+            self.unlink(shm)                            # a client that has not attached yet falls back to reading the files itself
+            print(f'Freed {key[0]} data from {key[1]}')
+
+    def precipData(self, precip_source, names, month_range):
+        '''The reply to a request for parsed precip data'''
+        import rainfall_sums
+        key = ('precip', precip_source, tuple(names), tuple(month_range))
+
+        return self.share(key, sourceStamp(precip_source, names), lambda: rainfall_sums.importPrecipData(month_range, precip_data_folder=precip_source, precip_contents=names, use_server=False))
+
+    def stationCoords(self, precip_source, year=1977):
+        '''The reply to a request for the station coordinates'''
+        import file_parsers as fp
+        names = [name for name in fp.precipSourceListing(precip_source) if fp.precipFileYear(name) == year]
+        key = ('coords', precip_source, year)
+
+        return self.share(key, sourceStamp(precip_source, names), lambda: fp.stationCoords(precip_source, year, use_server=False))
+
+    def handle(self, request):
+        '''This function answers one request
+
+        Args:
+            request (dict): the request sent by sendRequest()
+
+        Returns:
+            dict: the reply
+        '''
+        try:
+            if request['op'] == 'precip':
+                return self.precipData(request['source'], request['names'], request['month_range'])
+            if request['op'] == 'coords':
+                return self.stationCoords(request['source'], request['year'])
+            if request['op'] == 'status':
+                with self.lock:
+                    return {'blocks': [[list(key), list(shape)] for key, (_, _, shape) in self.blocks.items()]}
+            if request['op'] == 'shutdown':
+                return {'stopping': True}
+            return {'error': f'unknown op {request["op"]}'}
+        except Exception as e:                          # the client falls back to reading the files and will hit the same error itself
+            return {'error': f'{type(e).__name__}: {e}'}
+
+    @staticmethod
+    def unlink(shm):
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        '''This function frees every shared memory block'''
+        with self.lock:
+            for _, shm, _ in self.blocks.values():
+                self.unlink(shm)
+            self.blocks.clear()
+
+def commandLineParser():
+    '''This function parses the command line arguments
+
+    Returns:
+        argparse.namespace: an argparse namespace representing the command line arguments
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', type=str, help=f'the Unix socket to listen on. Defaults to ${SOCKET_ENV} or rainfall_server.sock in $XDG_RUNTIME_DIR (or in a private rainfall_server_<uid> folder in the temp folder). Clients must use the same one.')
+    parser.add_argument('--precip_data', type=str, default='./resources/precip_data', help='the folder of precip.YYYY files (plain or gzipped) or a .tar.gz/.tar.xz/.zip archive of them to load at startup. Defaults to ./resources/precip_data')
+    parser.add_argument('--unit_codes', type=int, nargs='+', default=[], help='load the precip data summed over the growing season of these unit codes at startup. Anything else is loaded on its first request.')
+    parser.add_argument('--max_blocks', type=int, default=8, help='how many parsed arrays to keep. The least recently used are freed first. Defaults to 8')
+    parser.add_argument('--max_memory', type=float, help='how much shared memory (in MiB) the parsed arrays may use together. Defaults to no limit')
+    parser.add_argument('--status', action='store_true', help='print what a running server holds and exit.')
+    parser.add_argument('--stop', action='store_true', help='stop a running server and exit.')
+    args = parser.parse_args()
+
+    return args
+
+def body(cmd_args):
+    '''This function runs the server until it is stopped
+
+    Args:
+        cmd_args (argparse.Namespace): an argparse namespace
+    '''
+    import signal
+    import socketserver
+    import threading
+    import file_parsers as fp
+    socket_path = socketPath(cmd_args.socket)
+    if sendRequest({'op': 'status'}, socket_path) is not None:
+        raise RuntimeError(f'a precip server is already listening on {socket_path}.')
+    if os.path.exists(socket_path):
+        os.remove(socket_path)                          # left behind by a server that did not shut down cleanly
+    data = DataServer(cmd_args.max_blocks, cmd_args.max_memory * 2**20 if cmd_args.max_memory else None)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            self.wfile.write((json.dumps(data.handle(request)) + '\n').encode())
+            if request.get('op') == 'shutdown':
+                threading.Thread(target=self.server.shutdown).start()
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    os.chmod(socket_path, 0o600)                        # only this user may connect
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        # load what will be asked for anyway
+        precip_source = os.path.abspath(cmd_args.precip_data)
+        if os.path.exists(precip_source):
+            data.stationCoords(precip_source)
+            names = fp.precipSourceListing(precip_source)
+            for unit_code in cmd_args.unit_codes:
+                data.precipData(precip_source, names, [int(month) for month in fp.cropCalendarParser(unit_code)])
+        print(f'Serving precip data on {socket_path}')
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        data.close()
+
+def main():
+    # get command line arguments
+    cmd_args = commandLineParser()
+    if cmd_args.status or cmd_args.stop:
+        reply = sendRequest({'op': 'shutdown' if cmd_args.stop else 'status'}, cmd_args.socket)
+        if reply is None:
+            print(f'No precip server is listening on {socketPath(cmd_args.socket)}.')
+        elif cmd_args.status:
+            for key, shape in reply['blocks']:
+                print(f'{key[0]:<8}{key[1]}  {shape}')
+        return
+    try:
+        body(cmd_args)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# This script is a single entry point for every other script in this project. e.g. python rainfall_cli.py gamma_calculations data.csv 30
+# Caleb Bitting (Colby Class of 2023)
+# Written for research for Professor Daniel LaFave at Colby College
+#
+# Only the module of the chosen subcommand is imported, and the scripts themselves import pandas, scipy, geopandas, etc.
+# inside the functions that use them, so --help and small runs don't pay for dependencies they never touch.
+
+import os
+import sys
+import argparse
+import importlib
+import subprocess
+
+SUBCOMMANDS = {
+    'create_rainfall_data': 'run every step needed to create the finalized csv of %-ile rainfall data',
+    'rainfall_sums': 'sum the rainfall of the precip stations near each DHS cluster',
+    'gamma_calculations': 'fit gamma distributions to the rainfall sums and calculate percentiles',
+    'csv_polishing': 'turn the output of gamma_calculations into the finalized csv',
+    'update_rainfall_data': 'extend an existing build with new or changed precip files',
+    'determine_distance': 'help choose the maximum distance between a DHS cluster and a precip station',
+    'mother_parsers': 'turn DHS survey data into mother-level data',
+    'hazard_regressions': 'run the hazard regressions',
+    'precip_server': 'keep the precip data in shared memory for the other scripts',
+}
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'geopandas', 'shapely', 'lifelines', 'matplotlib', 'haversine', 'tqdm', 'termcolor']
+
+def commandLineParser(argv=None):
+    '''This function parses the command line arguments. Everything after the subcommand is handed untouched to that script's own parser.
+
+    Args:
+        argv (list, optional): the arguments to parse. Defaults to sys.argv[1:]
+
+    Returns:
+        argparse.namespace: an argparse namespace representing the command line arguments
+    '''
+    description = '\n'.join(f'  {name:<22}{help_str}' for name, help_str in SUBCOMMANDS.items())
+    parser = argparse.ArgumentParser(description=f'subcommands:\n{description}\n  {"import_times":<22}check how long each script takes to import and to print its --help', formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subcommand', choices=list(SUBCOMMANDS) + ['import_times'], metavar='subcommand', help='the script to run. Pass --help after it to see its own arguments.')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='the arguments for the script.')
+    args = parser.parse_args(argv)
+
+    return args
+
+def freshRun(code, cwd=None):
+    '''This function runs timed code in a fresh interpreter and reports which heavy dependencies it pulled in
+
+    Args:
+        code (str): the code to time. Anything it prints is discarded.
+        cwd (str, optional): the directory to run it in. Defaults to the directory of this file.
+
+    Returns:
+        tuple: the time in seconds and a list of the heavy dependencies in sys.modules afterwards
+    '''
+    if cwd is None:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+    wrapper = ('import io, sys, time, contextlib\n'
+               't = time.perf_counter()\n'
+               'with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):\n'
+               '    try:\n'
+               f'        exec({code!r})\n'
+               '    except SystemExit:\n'
+               '        pass\n'
+               'print(time.perf_counter() - t)\n'
+               f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))\n')
+    output = subprocess.run([sys.executable, '-c', wrapper], cwd=cwd, capture_output=True, text=True, check=True).stdout.split('\n')
+    heavy = [name for name in output[1].split(',') if name]
+
+    return float(output[0]), heavy
+
+def importTime(module_name, cwd=None):
+    '''This function imports a module in a fresh interpreter and measures how long it takes
+
+    Args:
+        module_name (str): the module to import
+        cwd (str, optional): the directory to import from. Defaults to the directory of this file.
+
+    Returns:
+        tuple: the import time in seconds and a list of the heavy dependencies that the import pulled in
+    '''
+    return freshRun(f'import {module_name}', cwd)
+
+def helpTime(subcommand, cwd=None):
+    '''This function runs `rainfall_cli.py <subcommand> --help` in a fresh interpreter and measures how long it takes
+
+    Args:
+        subcommand (str): one of SUBCOMMANDS
+        cwd (str, optional): the directory to run it from. Defaults to the directory of this file.
+
+    Returns:
+        tuple: the time in seconds and a list of the heavy dependencies that --help pulled in
+    '''
+    return freshRun(f'import rainfall_cli; rainfall_cli.main([{subcommand!r}, "--help"])', cwd)
+
+def importTimes(max_seconds=0.25):
+    '''This function checks that every script imports, and prints its --help, quickly and without any heavy dependencies
+
+    Args:
+        max_seconds (float, optional): the longest any one import or --help may take. Defaults to 0.25
+
+    Returns:
+        bool: whether or not every script passed
+    '''
+    passed = True
+    for module_name in ['rainfall_cli'] + list(SUBCOMMANDS):
+        seconds, heavy = importTime(module_name)
+        help_seconds, help_heavy = helpTime(module_name) if module_name in SUBCOMMANDS else (0., [])
+        heavy = list(dict.fromkeys(heavy + help_heavy))
+        ok = max(seconds, help_seconds) <= max_seconds and not heavy
+        passed = passed and ok
+        help_str = f'{help_seconds * 1000:8.1f} ms --help' if module_name in SUBCOMMANDS else ''
+        print(f'{"ok  " if ok else "FAIL"} {module_name:<22}{seconds * 1000:8.1f} ms import{help_str:>20}{"   imports " + ", ".join(heavy) if heavy else ""}')
+
+    return passed
+
+def main(argv=None):
+    cmd_args = commandLineParser(argv)
+    if cmd_args.subcommand == 'import_times':
+        sys.exit(0 if importTimes() else 1)
+    # hand off to the script as if it had been called directly
+    module = importlib.import_module(cmd_args.subcommand)
+    sys.argv = [f'{os.path.basename(sys.argv[0])} {cmd_args.subcommand}'] + cmd_args.script_args
+    module.main()
+
+if __name__ == '__main__':
+    main()
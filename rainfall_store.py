@@ -0,0 +1,201 @@
+# This file will contain the methods needed to store the processed rainfall data as an index that the DHS data can be joined against quickly
+# Caleb Bitting (Colby Class of 2023)
+# Written for research for Professor Daniel LaFave at Colby College
+#
+# The store sits next to the processed csv (<csv>.store.npz). Every column is a dense (cluster, year) grid, so the row of a
+# DHSID and Year is cluster * num_years + (Year - first_year) and attaching a column to a table of mothers is one gather.
+
+import os
+
+def storePath(csv_path):
+    '''The path of the store that sits next to a processed csv
+
+    Args:
+        csv_path (str): the path to the processed csv written by create_rainfall_data.py
+
+    Returns:
+        str: the path to the store
+    '''
+    return csv_path + '.store.npz'
+
+def csvStats(csv_path):
+    '''The size and modification time of the processed csv. Used to tell whether a store is out of date.
+
+    Args:
+        csv_path (str): the path to the processed csv
+
+    Returns:
+        list: [size in bytes, modification time in nanoseconds]
+    '''
+    stat = os.stat(csv_path)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+def writeStore(csv_path, df=None):
+    '''This function indexes the processed rainfall data and writes the store. Call it after the csv has been written.
+
+    Args:
+        csv_path (str): the path to the processed csv
+        df (pd.DataFrame, optional): the processed data, if it is already in memory. Defaults to reading csv_path
+
+    Returns:
+        str: the path to the store
+    '''
+    import numpy as np
+    import pandas as pd
+    if df is None:
+        df = pd.read_csv(csv_path)
+    df = df.drop_duplicates(['DHSID', 'Year'])
+    dhsids, clusters = np.unique(np.asarray(df['DHSID'], dtype=str), return_inverse=True)
+    years = df['Year'].to_numpy(dtype=np.int64)
+    first_year = int(years.min()) if len(years) else 0
+    num_years = int(years.max()) - first_year + 1 if len(years) else 0
+    rows = clusters * num_years + (years - first_year)
+    columns = [column for column in df.columns if column not in ('DHSID', 'Year')]
+    grids = {}
+    for index, column in enumerate(columns):
+        # drought flags are stored as bytes and missing cells read as 0 (no shock). Everything else is float64 and missing cells read as NaN
+        if df[column].dtype == bool:
+            grid = np.zeros(len(dhsids) * num_years, dtype=np.uint8)
+        else:
+            grid = np.full(len(dhsids) * num_years, np.nan)
+        grid[rows] = df[column].to_numpy(dtype=grid.dtype)
+        grids[f'column_{index}'] = grid
+    path = storePath(csv_path)
+    with open(path, 'wb') as f:
+        np.savez(f, dhsid=dhsids, first_year=first_year, num_years=num_years, columns=np.array(columns, dtype=str), source=np.array(csvStats(csv_path)), **grids)
+
+    return path
+
+def readStore(csv_path):
+    '''This function opens the store of a processed csv, (re)building it first if it is missing or older than the csv
+
+    Args:
+        csv_path (str): the path to the processed csv
+
+    Returns:
+        RainfallStore: the store
+    '''
+    import numpy as np
+    path = storePath(csv_path)
+    if os.path.exists(path):
+        with np.load(path) as npz:
+            up_to_date = npz['source'].tolist() == csvStats(csv_path)
+    else:
+        up_to_date = False
+    if not up_to_date:
+        print(f'Indexing {csv_path} into {path}')
+        writeStore(csv_path)
+
+    return RainfallStore(path)
+
+class RainfallStore():
+    '''The processed rainfall data indexed by DHSID and Year. Columns are only read from disk when they are first gathered.'''
+
+    def __init__(self, path):
+        '''
+        Args:
+            path (str): the path to the store written by writeStore()
+        '''
+        import numpy as np
+        self.npz = np.load(path)
+        self.dhsids = self.npz['dhsid']                 # sorted, so DHSIDs are found with a binary search
+        self.first_year = int(self.npz['first_year'])
+        self.num_years = int(self.npz['num_years'])
+        self.columns = self.npz['columns'].tolist()
+        self.loaded = {}
+        self.coded = (0, None)                          # (codes covered, cluster of each integer code) for lookups by compact_storage codes
+
+    def clusters(self, dhsids):
+        '''This function finds the cluster of each DHSID
+
+        Args:
+            dhsids (array-like): the DHSIDs
+
+        Returns:
+            np.array: the index of each DHSID in the store, or -1 where the store does not have it
+        '''
+        import numpy as np
+        dhsids = np.asarray(dhsids).astype(str)
+        if not len(self.dhsids):
+            return np.full(len(dhsids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.dhsids, dhsids), len(self.dhsids) - 1)
+
+        return np.where(self.dhsids[positions] == dhsids, positions, -1)
+
+    def codedClusters(self, dictionary):
+        '''This function maps every integer code of the key dictionary to its cluster. Only codes added since the last call are looked up.
+
+        Args:
+            dictionary (dict): the key dictionary of compact_storage
+
+        Returns:
+            np.array: the cluster of each code, or -1 where the store does not have its DHSID
+        '''
+        import numpy as np
+        covered, code_clusters = self.coded
+        keys = dictionary['DHSID']
+        if code_clusters is None or covered < len(keys):
+            new_clusters = self.clusters(keys[covered:])
+            code_clusters = new_clusters if code_clusters is None else np.concatenate([code_clusters, new_clusters])
+            self.coded = (len(keys), code_clusters)
+
+        return code_clusters
+
+    def offsets(self, dhsids, years, dictionary=None):
+        '''This function finds the row of each DHSID and Year
+
+        Args:
+            dhsids (array-like): the DHSIDs, or their integer codes if dictionary is passed
+            years (array-like): the years
+            dictionary (dict, optional): the key dictionary of compact_storage the codes come from. The codes are joined on directly and never decoded. Defaults to None
+
+        Returns:
+            np.array: the row of each DHSID and Year, or -1 where the store has no such row
+        '''
+        import numpy as np
+        import pandas as pd
+        if dictionary is not None:
+            codes = np.asarray(dhsids, dtype=np.int64)
+            clusters = np.where(codes >= 0, self.codedClusters(dictionary)[np.maximum(codes, 0)], -1)
+        else:
+            # look up each distinct DHSID once
+            codes, uniques = pd.factorize(np.asarray(dhsids))
+            clusters = self.clusters(uniques)[codes]
+            clusters[codes < 0] = -1                    # missing DHSIDs
+        year_indices = np.asarray(years, dtype=np.int64) - self.first_year
+        valid = (clusters >= 0) & (year_indices >= 0) & (year_indices < self.num_years)
+
+        return np.where(valid, clusters * self.num_years + year_indices, -1)
+
+    def column(self, name):
+        '''The flat grid of one column
+
+        Args:
+            name (str): the column name. e.g. '<5%-ile'
+
+        Returns:
+            np.array: the grid, with one entry per cluster and year
+        '''
+        if name not in self.columns: raise KeyError(f'{name} must be one of {self.columns}.')
+        if name not in self.loaded:
+            self.loaded[name] = self.npz[f'column_{self.columns.index(name)}']
+
+        return self.loaded[name]
+
+    def gather(self, name, offsets):
+        '''This function reads one column at the rows returned by offsets()
+
+        Args:
+            name (str): the column name
+            offsets (np.array): the rows returned by offsets()
+
+        Returns:
+            np.array: the values. Rows the store does not have are 0 for drought flags and NaN otherwise
+        '''
+        import numpy as np
+        grid = self.column(name)
+        values = grid.take(np.maximum(offsets, 0)) if len(grid) else np.zeros(len(offsets), dtype=grid.dtype)
+        values[offsets < 0] = 0 if grid.dtype == np.uint8 else np.nan
+
+        return values
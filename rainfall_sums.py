@@ -4,39 +4,121 @@
 #
 
 import os
+import json
 import argparse
 import itertools
 import statistics
 import file_parsers as fp
-from termcolor import cprint
-from tqdm import tqdm as progress
 
-def importPrecipData(month_range, windows='', precip_data_folder='./resources/precip_data', testing=False):
-    '''This function imports all precip data in ./resources/precip_data or another specified folder
+KERNELS = ['uniform', 'inverse_distance', 'gaussian']      # how the stations matched to a DHS cluster are weighted
+MIN_DISTANCE = 1.                                           # km. Keeps a station sitting on top of a cluster from taking all of the inverse-distance weight
+
+def precipFileNames(windows='', precip_data_folder='./resources/precip_data', testing=False):
+    '''This function lists the precip files that make up a run
     
     Args:
-        month_range (list): a list of months across which to sum the rainfall
         windows (str, optional): a string representing the path to the file containing the names of the precip files. Defaults to the empty string.
-        precip_data_folder (str, optional): a string representing the path to the folder in which all of the .precip files are stored. Defaults to './resources/precip_data'
+        precip_data_folder (str, optional): a string representing the path to the folder in which all of the .precip files (plain or gzipped) are stored, or to a .tar.gz/.tar.xz/.zip archive of them. Defaults to './resources/precip_data'
         testing (bool, optional): wheter or not the function is in testing mode. If so, only the first ten precip files will be considered for speed. Defaults to False
     
     Returns:
-        list: a list of parsed precip data. Of the form [[[x1, y1], SUM2], [[x2, y2], SUM2], ...] where SUM is the sum of the rainfall in the selected months
+        list: the names of the precip files in the order they will be parsed
     '''
-    # get list of precip files
     if windows:
         precip_contents = fp.precipListParser(windows, testing=testing)
     else:
-        os.system(f'cd {precip_data_folder}; ls precip* > ../../precip.txt')
-        precip_contents = fp.precipListParser('precip.txt', testing=testing)
-        os.system('rm precip.txt')
-    # modify the path variable
-    precip_contents = ['./resources/precip_data/' + file for file in precip_contents]
-    # create precip data list for them all
-    precip_data = [fp.precipFileParser(path, month_range) for path in progress(precip_contents, desc='Importing precip data')]
+        precip_contents = fp.precipSourceListing(precip_data_folder)
+        if testing:
+            precip_contents = precip_contents[:10]      # only take the first ten items if testing is passed as True
+
+    return precip_contents
+
+def importPrecipData(month_range, windows='', precip_data_folder='./resources/precip_data', testing=False, precip_contents=None, use_server=True):
+    '''This function imports all precip data in ./resources/precip_data or another specified folder or archive. Files are read (and decompressed) in a background thread while the previous one is parsed.
+    
+    Args:
+        month_range (list): a list of months across which to sum the rainfall
+        windows (str, optional): a string representing the path to the file containing the names of the precip files. Defaults to the empty string.
+        precip_data_folder (str, optional): a string representing the path to the folder in which all of the .precip files (plain or gzipped) are stored, or to a .tar.gz/.tar.xz/.zip archive of them. Defaults to './resources/precip_data'
+        testing (bool, optional): wheter or not the function is in testing mode. If so, only the first ten precip files will be considered for speed. Defaults to False
+        precip_contents (list, optional): the names of the precip files to parse. If not passed, every file returned by precipFileNames() is parsed.
+        use_server (bool, optional): whether to get the data from precip_server.py if it is running. Defaults to True
+    
+    Returns:
+        list: a list of parsed precip data. Of the form [[[x1, y1], SUM2], [[x2, y2], SUM2], ...] where SUM is the sum of the rainfall in the selected months.
+              When precip_server.py supplies the data it is a read-only np.array (years by stations) in shared memory instead.
+    '''
+    from tqdm import tqdm as progress
+    # get list of precip files
+    if precip_contents is None:
+        precip_contents = precipFileNames(windows, precip_data_folder, testing)
+    if use_server:
+        import precip_server
+        precip_data = precip_server.requestPrecipData(precip_data_folder, precip_contents, month_range)
+        if precip_data is not None:
+            return precip_data
+    # create precip data list for them all. Archives hand files back in archive order
+    parsed = {}
+    for name, text in progress(fp.prefetch(fp.readPrecipFiles(precip_data_folder, precip_contents)), total=len(precip_contents), desc='Importing precip data'):
+        parsed[name] = fp.precipFileParser(name, month_range, raw_file_contents=text)
+    missing = [name for name in precip_contents if name not in parsed]
+    if missing: raise FileNotFoundError(f'{precip_data_folder} does not contain {missing}.')
+    precip_data = [parsed[name] for name in precip_contents]
 
     return precip_data
 
+def precipFileStats(precip_contents, precip_data_folder='./resources/precip_data'):
+    '''This function records the size and modification time of each precip file so later runs can tell whether it changed
+    
+    Args:
+        precip_contents (list): the names of the precip files
+        precip_data_folder (str, optional): the folder (or archive) in which the precip files are stored. Defaults to './resources/precip_data'
+    
+    Returns:
+        list: a list of dicts of the form [{'name': 'precip.1950', 'size': 123, 'mtime': 456}, ...]
+    '''
+    return fp.precipSourceStats(precip_data_folder, precip_contents)
+
+def manifestPath(csv_name):
+    '''The path of the manifest that sits next to a rainfall sums csv
+    
+    Args:
+        csv_name (str): the path to the rainfall sums csv
+    
+    Returns:
+        str: the path to the manifest
+    '''
+    return csv_name + '.manifest.json'
+
+def writeManifest(csv_name, precip_contents, month_range, precip_data_folder='./resources/precip_data', kernels=('uniform',), bandwidth=None):
+    '''This function writes a json manifest recording which precip files (and which months and kernels) built a rainfall sums csv
+    
+    Args:
+        csv_name (str): the path to the rainfall sums csv
+        precip_contents (list): the names of the precip files in the order their totals appear in 'Rainfall Totals'
+        month_range (list): the months across which the rainfall was summed
+        precip_data_folder (str, optional): the folder (or archive) in which the precip files are stored. Defaults to './resources/precip_data'
+        kernels (iterable, optional): the kernels the totals were weighted with, in the order of their columns. Defaults to ('uniform',)
+        bandwidth (float, optional): the bandwidth (in km) of the gaussian kernel. Defaults to None
+    '''
+    manifest = {'month_range': list(month_range), 'files': precipFileStats(precip_contents, precip_data_folder), 'kernels': list(kernels), 'bandwidth': bandwidth}
+    with open(manifestPath(csv_name), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+def readManifest(csv_name):
+    '''This function reads the manifest written by writeManifest()
+    
+    Args:
+        csv_name (str): the path to the rainfall sums csv
+    
+    Returns:
+        dict: the manifest, or None if the csv was written without one
+    '''
+    if not os.path.exists(manifestPath(csv_name)):
+        return None
+    with open(manifestPath(csv_name), 'r') as f:
+        return json.load(f)
+
 def commandLineParser():
     '''This function parses the command line arguments
     
@@ -50,24 +132,150 @@ def commandLineParser():
     parser.add_argument('--csv_name', type=str, default='data.csv', help='the name of the csv to which this program will write. Defaults to data.csv')
     parser.add_argument('--testing', action='store_true', help='enter testing mode. All functions will be passed testing=True where possible.')
     parser.add_argument('--windows', '-w', type=str, help='the file path for the list of the names of precip files.')
+    parser.add_argument('--precip_data', type=str, default='./resources/precip_data', help='the folder of precip.YYYY files (plain or gzipped) or a .tar.gz/.tar.xz/.zip archive of them. Defaults to ./resources/precip_data')
+    parser.add_argument('--full_shapefile', action='store_true', help='build a GeoDataFrame with every column of the shapefile instead of reading only DHSID and the cluster coordinates. Every column is then written to the csv.')
+    parser.add_argument('--compact', action='store_true', help='keep the rainfall totals as one float64 array instead of lists of Python floats. Reports the memory saved.')
+    parser.add_argument('--kernels', type=str, nargs='+', choices=KERNELS, default=['uniform'], help='how to weight the stations within --distance of each cluster. The first kernel is written to "Rainfall Totals" and any others to "Rainfall Totals (<kernel>)". Defaults to uniform')
+    parser.add_argument('--bandwidth', type=float, help='the standard deviation (in km) of the gaussian kernel. Defaults to half of --distance')
     parser.add_argument('--determine_distance', default=False, help='needed for file_parsers. DO NOT TOUCH.')
     args = parser.parse_args()
 
     return args
 
-def generateRainFallSums(index_list, precip_data):
-    '''This function generates all rainfall sums for a particular location.
+def kernelWeights(distances, kernel='uniform', bandwidth=None):
+    '''This function weights stations by their distance from a DHS cluster
     
     Args:
-        index_list (list): all of the relevant indices. 'Station Indices' column in GeoDataFrame.
-        precip_data (list): 2-D list of all rainfall data. Returned by fp.precipFileParser()
+        distances (np.array): the distances (in km) between clusters and their matched stations
+        kernel (str, optional): one of KERNELS. Defaults to 'uniform'
+        bandwidth (float, optional): the standard deviation (in km) of the gaussian kernel. Defaults to None
     
     Returns:
-        list: the sums for every rainfall year of the relevant stations. Of the form [sum1, sum2, sum3, ...]
+        np.array: the weight of each station
     '''
-    rainfall_totals = [sum([item for index, item in enumerate(lst) if index in index_list]) for lst in precip_data]
+    import numpy as np
+    if kernel == 'uniform':
+        return np.ones(len(distances))
+    if kernel == 'inverse_distance':
+        return 1 / np.maximum(distances, MIN_DISTANCE)
+    if kernel == 'gaussian':
+        if not bandwidth: raise ValueError(f'the gaussian kernel needs a positive bandwidth. You passed {bandwidth}.')
+        return np.exp(-.5 * (np.asarray(distances) / bandwidth) ** 2)
+    raise ValueError(f'kernel must be one of {KERNELS}. You passed {kernel}.')
+
+def weightMatrix(station_indices, station_distances, num_stations, kernel='uniform', bandwidth=None):
+    '''This function builds the sparse cluster by station weight matrix for one kernel.
+    Uniform weights are all 1, so the totals are the plain sums over the matched stations. Other kernels are rescaled so each
+    cluster's weights still add up to its number of stations, which keeps their totals on the same scale as the uniform ones.
+    
+    Args:
+        station_indices (list): the 'Station Indices' column in GeoDataFrame.
+        station_distances (list): the 'Station Distances' column in GeoDataFrame. Only needed for kernels other than uniform.
+        num_stations (int): the number of stations in each precip file
+        kernel (str, optional): one of KERNELS. Defaults to 'uniform'
+        bandwidth (float, optional): the standard deviation (in km) of the gaussian kernel. Defaults to None
+    
+    Returns:
+        scipy.sparse.csr_matrix: the weights (clusters by stations)
+    '''
+    import numpy as np
+    import scipy.sparse as sparse
+    lengths = np.array([len(index_list) for index_list in station_indices], dtype=np.int64)
+    rows = np.repeat(np.arange(len(station_indices)), lengths)
+    columns = np.fromiter(itertools.chain.from_iterable(station_indices), dtype=np.int64, count=lengths.sum())
+    if kernel == 'uniform':
+        weights = np.ones(len(columns))
+    else:
+        if station_distances is None: raise ValueError(f'the {kernel} kernel needs the station distances. Rebuild the rainfall sums so that they include "Station Distances".')
+        distances = np.fromiter(itertools.chain.from_iterable(station_distances), dtype=np.float64, count=lengths.sum())
+        weights = kernelWeights(distances, kernel, bandwidth)
+        totals = np.bincount(rows, weights, minlength=len(station_indices))
+        scale = np.divide(lengths, totals, out=np.zeros(len(totals)), where=totals > 0)
+        weights *= scale[rows]
+
+    return sparse.csr_matrix((weights, (rows, columns)), shape=(len(station_indices), num_stations))
+
+def weightedRainFallSums(weights, precip_data):
+    '''This function generates the rainfall totals of every location for every year in one matrix multiplication.
+    
+    Args:
+        weights (scipy.sparse.csr_matrix): the matrix returned by weightMatrix()
+        precip_data (list): 2-D list of all rainfall data. Returned by importPrecipData()
+    
+    Returns:
+        np.array: the rainfall totals (locations by years)
+    '''
+    import numpy as np
+    precip_array = np.asarray(precip_data, dtype=np.float64).reshape(len(precip_data), weights.shape[1])      # years by stations
+
+    return np.asarray(weights @ precip_array.T)
+
+def totalsColumn(kernel, kernels):
+    '''The column that holds the totals of one kernel
+    
+    Args:
+        kernel (str): the kernel
+        kernels (list): every kernel in the run. The first one is written to 'Rainfall Totals'
+    
+    Returns:
+        str: the column name
+    '''
+    return 'Rainfall Totals' if kernel == kernels[0] else f'Rainfall Totals ({kernel})'
+
+def kernelOutputFile(output_file, kernel, kernels):
+    '''The processed csv of one kernel
+    
+    Args:
+        output_file (str): the processed csv of the first kernel. e.g. create_rainfall_data.py --output_file
+        kernel (str): the kernel
+        kernels (list): every kernel in the run. The first one is written to output_file itself
+    
+    Returns:
+        str: the path of the processed csv. e.g. cleanGamma_data_gaussian.csv
+    '''
+    if kernel == kernels[0]:
+        return output_file
+    root, extension = os.path.splitext(output_file)
+
+    return f'{root}_{kernel}{extension}'
+
+def kernelBandwidth(cmd_args):
+    '''The bandwidth (in km) of the gaussian kernel. Defaults to half of the maximum distance.'''
+    bandwidth = getattr(cmd_args, 'bandwidth', None)
+
+    return bandwidth if bandwidth else cmd_args.distance / 2
+
+def compactRainFallSums(weights, precip_data):
+    '''This function generates the rainfall sums of every location as one float64 array instead of a list of lists of Python floats.
+    The totals stay float64 because the gamma fits are sensitive to small changes in them; only the percentiles and the processed csv are stored as float32.
+    
+    Args:
+        weights (scipy.sparse.csr_matrix): the matrix returned by weightMatrix()
+        precip_data (list): 2-D list of all rainfall data. Returned by importPrecipData()
+    
+    Returns:
+        np.array: the rainfall totals (locations by years)
+    '''
+    import compact_storage as cs
+    rainfall_totals = weightedRainFallSums(weights, precip_data)
+    cs.memoryReport('Rainfall totals', 8 * rainfall_totals.shape[0] + rainfall_totals.size * 32, rainfall_totals.nbytes)      # a list of lists of Python floats is 8 bytes of pointer plus a 24 byte float per item
+
     return rainfall_totals
 
+def listifyTotals(gdf):
+    '''This function turns 'Rainfall Totals' arrays (of every kernel) back into lists so they are written to csv as json
+    
+    Args:
+        gdf (DataFrame): the DataFrame returned by body()
+    
+    Returns:
+        DataFrame: the same DataFrame
+    '''
+    for column in [column for column in gdf.columns if column.startswith('Rainfall Totals')]:
+        gdf[column] = [totals if isinstance(totals, list) else totals.tolist() for totals in gdf[column]]
+
+    return gdf
+
 def body(cmd_args):
     '''This function runs the main functionality
     
@@ -75,20 +283,31 @@ def body(cmd_args):
         cmd_args (argparse.Namespace): an argparse namespace
     
     Returns:
-        GeoDataFrame: a GeoPandas GeoDataFrame with all of the rainfall sums included.
+        DataFrame: a DataFrame (a GeoPandas GeoDataFrame with --full_shapefile) with all of the rainfall sums included.
     '''
+    from termcolor import cprint
+    from tqdm import tqdm as progress
     # parse month range
     month_range = fp.cropCalendarParser(cmd_args.unit_code)
     month_range = [int(month) for month in month_range]
     # get precip data
-    precip_data = importPrecipData(month_range, windows=cmd_args.windows, testing=cmd_args.testing)
+    precip_source = getattr(cmd_args, 'precip_data', './resources/precip_data')
+    precip_contents = precipFileNames(cmd_args.windows, precip_source, testing=cmd_args.testing)
+    precip_data = importPrecipData(month_range, precip_data_folder=precip_source, precip_contents=precip_contents)
     # get geodata
-    st_coords = fp.precipFileParser('./resources/precip_data/precip.1977', [4, 8], return_coords=True)
-    gdf = fp.shapeFileParser(cmd_args.shapefile_path, st_coords, cmd_args, testing=cmd_args.testing)
-    # generate rainfall totals
+    st_coords = fp.stationCoords(precip_source)
+    gdf = fp.shapeFileParser(cmd_args.shapefile_path, st_coords, cmd_args, testing=cmd_args.testing, full_geodataframe=getattr(cmd_args, 'full_shapefile', False))
+    # generate rainfall totals for every kernel from the same matched stations
     station_indices = gdf['Station Indices'].tolist()
-    rainfall_totals = [generateRainFallSums(index_list, data) for index_list, data in progress(zip(station_indices, itertools.repeat(precip_data)), total=len(gdf['Station Indices']), desc='Calculating rainfall sums')]
-    gdf['Rainfall Totals'] = rainfall_totals
+    station_distances = gdf['Station Distances'].tolist()
+    kernels = getattr(cmd_args, 'kernels', ['uniform'])
+    for kernel in progress(kernels, desc='Calculating rainfall sums'):
+        weights = weightMatrix(station_indices, station_distances, len(precip_data[0]), kernel, kernelBandwidth(cmd_args))
+        column = totalsColumn(kernel, kernels)
+        if getattr(cmd_args, 'compact', False):
+            gdf[column] = list(compactRainFallSums(weights, precip_data))
+        else:
+            gdf[column] = weightedRainFallSums(weights, precip_data).tolist()
     # print out needed calculation stats
     station_lengths = [len(lst) for lst in station_indices]     # how many stations were captured
     _, columns = os.popen('stty size', 'r').read().split()
@@ -109,7 +328,10 @@ def main():
     gdf = body(cmd_args)
     # store in csv
     if '.csv' not in cmd_args.csv_name: cmd_args.csv_name += '.csv'
-    gdf.to_csv(cmd_args.csv_name, index=False)
+    listifyTotals(gdf).to_csv(cmd_args.csv_name, index=False)
+    # record what went into the csv so update_rainfall_data.py can extend it
+    month_range = [int(month) for month in fp.cropCalendarParser(cmd_args.unit_code)]
+    writeManifest(cmd_args.csv_name, precipFileNames(cmd_args.windows, cmd_args.precip_data, testing=cmd_args.testing), month_range, cmd_args.precip_data, cmd_args.kernels, kernelBandwidth(cmd_args))
 
 if __name__ == '__main__':
     main()
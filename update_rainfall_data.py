@@ -0,0 +1,219 @@
+# This script will bring an existing rainfall build up to date when new (or revised) precip.YYYY files are released
+# Caleb Bitting (Colby Class of 2023)
+# Written for research for Professor Daniel LaFave at Colby College
+#
+
+import json
+import argparse
+import rainfall_sums
+import rainfall_store
+import file_parsers as fp
+import csv_polishing
+import gamma_calculations
+
+def commandLineParser():
+    '''This function parses the command line arguments
+
+    Returns:
+        argparse.namespace: an argparse namespace representing the command line arguments
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sums_file', type=str, help='the path to the csv of rainfall sums written by rainfall_sums.py (or create_rainfall_data.py --sums_file). It is updated in place.')
+    parser.add_argument('output_file', type=str, help='the path to the processed csv written by create_rainfall_data.py (of the first kernel, if several were run). It is updated in place, along with the _<kernel> csv of every other kernel.')
+    parser.add_argument('len_years', type=int, help='the number of years to use to fit each gamma distribution. Must match the original build.')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=csv_polishing.DEFAULT_THRESHOLDS, help='the percentile thresholds below which a year counts as a drought. Must match the original build. Defaults to .05 .10 .15')
+    parser.add_argument('--precip_data_folder', type=str, default='./resources/precip_data', help='the folder in which all of the precip files (plain or gzipped) are stored, or a .tar.gz/.tar.xz/.zip archive of them. Defaults to ./resources/precip_data')
+    args = parser.parse_args()
+
+    return args
+
+def changedFiles(manifest, precip_contents, precip_data_folder):
+    '''This function compares the precip folder against the manifest of the last build
+
+    Args:
+        manifest (dict): the manifest returned by rainfall_sums.readManifest()
+        precip_contents (list): the names of the precip files currently in the folder
+        precip_data_folder (str): the folder (or archive) in which the precip files are stored
+
+    Returns:
+        list: the indices (into precip_contents) of the files that are new or have changed since the last build
+    '''
+    old_files = manifest['files']
+    # new years may only be appended; anything else shifts every index in 'Rainfall Totals'
+    if [item['name'] for item in old_files] != precip_contents[:len(old_files)]:
+        raise ValueError('The precip files in the folder no longer start with the files of the last build. Rebuild from scratch with create_rainfall_data.py.')
+    current_stats = rainfall_sums.precipFileStats(precip_contents, precip_data_folder)
+    changed = [index for index, (old, new) in enumerate(zip(old_files, current_stats)) if old != new]
+    changed += list(range(len(old_files), len(precip_contents)))
+
+    return changed
+
+def affectedWindows(changed_indices, len_years, num_years):
+    '''This function finds every percentile window that contains a changed year
+
+    Args:
+        changed_indices (list): the indices of the years that are new or have changed
+        len_years (int): how many years are used to fit each gamma distribution
+        num_years (int): the total number of years of rainfall data
+
+    Returns:
+        list: the sorted indices of the target years whose percentile must be recomputed
+    '''
+    targets = set()
+    for index in changed_indices:
+        targets.update(range(max(index, len_years), min(index + len_years, num_years - 1) + 1))
+
+    return sorted(targets)
+
+def outputRows(dhsid, rainfall_list, percentile_dict, first_year, thresholds=csv_polishing.DEFAULT_THRESHOLDS):
+    '''This function creates the rows of the processed csv for one location. The columns match csv_polishing.body().
+
+    Args:
+        dhsid (str): the DHSID of the location
+        rainfall_list (list): the rainfall totals for the location
+        percentile_dict (dict): a dict mapping the index of a target year to its percentile
+        first_year (int): the year of the first rainfall total
+        thresholds (list, optional): the percentile thresholds. Defaults to [.05, .10, .15]
+
+    Returns:
+        list: the rows for the location
+    '''
+    indices = sorted(percentile_dict)
+    flags = csv_polishing.classifyPercentiles([percentile_dict[index] for index in indices], thresholds)
+    rows = []
+    for index, year_flags in zip(indices, flags.tolist()):
+        rows.append([dhsid, first_year + index, *year_flags, round(float(percentile_dict[index]), 4), round(float(rainfall_list[index]), 4)])
+
+    return rows
+
+def mergeOutput(output_df, new_df):
+    '''This function appends new rows to the processed csv, replacing any rows for the same DHSID and Year
+
+    Args:
+        output_df (pd.DataFrame): the existing processed data
+        new_df (pd.DataFrame): the recomputed rows
+
+    Returns:
+        pd.DataFrame: the updated data, still grouped by location in its original order and sorted by year
+    '''
+    import pandas as pd
+    location_order = {dhsid: index for index, dhsid in enumerate(dict.fromkeys(output_df['DHSID']))}
+    keys = pd.MultiIndex.from_frame(new_df[['DHSID', 'Year']])
+    keep = ~pd.MultiIndex.from_frame(output_df[['DHSID', 'Year']]).isin(keys)
+    df = pd.concat([output_df[keep], new_df], ignore_index=True)
+    df['order'] = df['DHSID'].map(location_order)
+    df.sort_values(['order', 'Year'], inplace=True, kind='stable')
+    df.drop('order', axis=1, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+def verifyOutput(output_df, dhsids, rainfall_list, len_years, first_year, thresholds=csv_polishing.DEFAULT_THRESHOLDS, sample_size=20, seed=0):
+    '''This function recomputes every year of a sample of locations from scratch and checks the updated processed csv against them
+
+    Args:
+        output_df (pd.DataFrame): the updated processed data
+        dhsids (list): the DHSID of every location in the rainfall sums
+        rainfall_list (list): the updated rainfall totals of every location
+        len_years (int): how many years are used to fit each gamma distribution
+        first_year (int): the year of the first rainfall total
+        thresholds (list, optional): the percentile thresholds. Defaults to [.05, .10, .15]
+        sample_size (int, optional): how many locations to check. Defaults to 20
+        seed (int, optional): the seed of the sample. Defaults to 0
+
+    Raises:
+        ValueError: if a location does not match what a full rebuild would write
+    '''
+    import random
+    import numpy as np
+    import pandas as pd
+    groups = output_df.groupby('DHSID', sort=False)
+    kept = [index for index, dhsid in enumerate(dhsids) if dhsid in groups.groups]
+    for index in random.Random(seed).sample(kept, min(sample_size, len(kept))):
+        percentile_dict = gamma_calculations.windowPercentiles(rainfall_list[index], len_years, range(len_years, len(rainfall_list[index])))
+        expected = pd.DataFrame(data=outputRows(dhsids[index], rainfall_list[index], percentile_dict, first_year, thresholds), columns=output_df.columns)
+        actual = groups.get_group(dhsids[index])
+        numeric = ['%-ile', 'Total Rainfall (mm)']
+        if not (actual['Year'].tolist() == expected['Year'].tolist() and np.allclose(actual[numeric].to_numpy(dtype=np.float64), expected[numeric].to_numpy(dtype=np.float64), atol=1e-3)):
+            raise ValueError(f'The processed csv does not match its rainfall sums for {dhsids[index]}. It may predate the fix to the DHSID labels. Rebuild from scratch with create_rainfall_data.py.')
+
+def body(cmd_args):
+    '''This function runs the main functionality
+
+    Args:
+        cmd_args (argparse.Namespace): an argparse namespace
+
+    Returns:
+        tuple: the updated rainfall sums DataFrame and a dict mapping the processed csv of every kernel to its updated DataFrame
+    '''
+    import os
+    import pandas as pd
+    from tqdm import tqdm as progress
+    sums_df = pd.read_csv(cmd_args.sums_file)
+    manifest = rainfall_sums.readManifest(cmd_args.sums_file)
+    if manifest is None:
+        raise FileNotFoundError(f'{rainfall_sums.manifestPath(cmd_args.sums_file)} does not exist. Rebuild with rainfall_sums.py or create_rainfall_data.py --sums_file so that a manifest is written.')
+    # every kernel of the build has its own processed csv, and all of them are updated together
+    kernels = manifest.get('kernels', ['uniform'])
+    output_files = {kernel: rainfall_sums.kernelOutputFile(cmd_args.output_file, kernel, kernels) for kernel in kernels}
+    missing = [output_file for output_file in output_files.values() if not os.path.exists(output_file)]
+    if missing: raise FileNotFoundError(f'{missing} do not exist. The sums were built with the kernels {kernels} and every kernel\'s processed csv is updated with them.')
+    output_dfs = {output_file: pd.read_csv(output_file) for output_file in output_files.values()}
+    station_indices = [json.loads(index_list) for index_list in sums_df['Station Indices']]
+    station_distances = [json.loads(distance_list) for distance_list in sums_df['Station Distances']] if 'Station Distances' in sums_df.columns else None     # older builds only kept the indices
+    # figure out what changed since the last build
+    precip_contents = fp.precipSourceListing(cmd_args.precip_data_folder)
+    changed = changedFiles(manifest, precip_contents, cmd_args.precip_data_folder)
+    if not changed:
+        print('Every precip file is unchanged. Nothing to update.')
+        return sums_df, output_dfs
+    print(f'Parsing {len(changed)} new or changed precip file(s): {[precip_contents[index] for index in changed]}')
+    # parse only the changed years
+    changed_data = rainfall_sums.importPrecipData(manifest['month_range'], precip_data_folder=cmd_args.precip_data_folder, precip_contents=[precip_contents[index] for index in changed])
+    # only the windows that contain a changed year need a new percentile
+    targets = affectedWindows(changed, cmd_args.len_years, len(precip_contents))
+    first_year = fp.precipFileYear(precip_contents[0])
+    for kernel in kernels:
+        # fold the changed years into the cached sums of the kernel
+        column = rainfall_sums.totalsColumn(kernel, kernels)
+        rainfall_list = [json.loads(rainfall_sum) for rainfall_sum in sums_df[column]]
+        weights = rainfall_sums.weightMatrix(station_indices, station_distances, len(changed_data[0]), kernel, manifest.get('bandwidth'))
+        for rainfall_totals, new_totals in zip(rainfall_list, rainfall_sums.weightedRainFallSums(weights, changed_data).tolist()):
+            for index, total in zip(changed, new_totals):
+                if index < len(rainfall_totals):
+                    rainfall_totals[index] = total
+                else:
+                    rainfall_totals.append(total)
+        sums_df[column] = [json.dumps(rainfall_totals) for rainfall_totals in rainfall_list]
+        # and the new percentiles into its processed csv
+        output_file = output_files[kernel]
+        output_df = output_dfs[output_file]
+        kept_locations = set(output_df['DHSID'])        # locations dropped by csv_polishing.dropOrigin() stay dropped
+        rows = []
+        for dhsid, rainfall_totals in progress(zip(sums_df['DHSID'], rainfall_list), total=len(rainfall_list), desc=f'Calculating Percentiles ({kernel})' if len(kernels) > 1 else 'Calculating Percentiles'):
+            if dhsid not in kept_locations:
+                continue
+            percentile_dict = gamma_calculations.windowPercentiles(rainfall_totals, cmd_args.len_years, targets)
+            rows += outputRows(dhsid, rainfall_totals, percentile_dict, first_year, cmd_args.thresholds)
+        new_df = pd.DataFrame(data=rows, columns=output_df.columns)
+        output_df = mergeOutput(output_df, new_df)
+        verifyOutput(output_df, sums_df['DHSID'].tolist(), rainfall_list, cmd_args.len_years, first_year, cmd_args.thresholds)
+        output_dfs[output_file] = output_df
+
+    return sums_df, output_dfs
+
+def main():
+    # get command line arguments
+    cmd_args = commandLineParser()
+    # call functionality
+    sums_df, output_dfs = body(cmd_args)
+    # store in csv
+    sums_df.to_csv(cmd_args.sums_file, index=False)
+    manifest = rainfall_sums.readManifest(cmd_args.sums_file)
+    rainfall_sums.writeManifest(cmd_args.sums_file, fp.precipSourceListing(cmd_args.precip_data_folder), manifest['month_range'], cmd_args.precip_data_folder, manifest.get('kernels', ['uniform']), manifest.get('bandwidth'))
+    for output_file, output_df in output_dfs.items():
+        output_df.to_csv(output_file, index=False)
+        rainfall_store.writeStore(output_file, output_df)
+
+if __name__ == '__main__':
+    main()